@@ -4,6 +4,8 @@ import { useState, useEffect, useRef } from 'react';
 import { useGameState } from '../context/GameStateContext';
 import { useConnection } from '../context/ConnectionContext';
 import PlayerCard from './PlayerCard';
+import { TransactionDefault } from "@coinbase/onchainkit/transaction";
+import { encodeFunctionData } from 'viem';
 
 interface Message {
   id: string;
@@ -27,6 +29,54 @@ export default function ChatRoom() {
   const [timeLeft, setTimeLeft] = useState(60); // 60 seconds game duration
   const [progress, setProgress] = useState(100); // Countdown progress bar
   
+  // Contract configuration
+  const BASE_SEPOLIA_CHAIN_ID = 84532;
+  const ContractAddress = '0x92bA074CDb98306cc6B0A75eD30dF7EC8E4240d5';
+  const ContractAbi = [
+    {
+      type: 'function',
+      name: 'createGame',
+      inputs: [
+        { internalType: 'string', name: 'gameId', type: 'string' }
+      ],
+      outputs: [],
+      stateMutability: 'nonpayable',
+    },
+    {
+      type: 'function',
+      name: 'joinGame',
+      inputs: [
+        { internalType: 'string', name: 'gameId', type: 'string' }
+      ],
+      outputs: [],
+      stateMutability: 'nonpayable',
+    },
+  ] as const;
+  
+  // The entry fee is paid into this room's game, which only exists once
+  // matchmaking has formed it. The server gives every room its own game id.
+  const createGameCalls = [
+    {
+      to: ContractAddress as `0x${string}`,
+      data: encodeFunctionData({
+        abi: ContractAbi,
+        functionName: 'createGame',
+        args: [currentGameId]
+      }) as `0x${string}`,
+    }
+  ];
+  
+  const joinGameCalls = [
+    {
+      to: ContractAddress as `0x${string}`,
+      data: encodeFunctionData({
+        abi: ContractAbi,
+        functionName: 'joinGame',
+        args: [currentGameId]
+      }) as `0x${string}`,
+    }
+  ];
+  
   // Replace messagesEndRef with chatContainerRef
   const chatContainerRef = useRef<HTMLDivElement>(null);
   
@@ -149,6 +199,27 @@ export default function ChatRoom() {
           ></div>
         </div>
         
+        <div className="grid grid-cols-2 gap-3 mb-6">
+          <div>
+            <p className="text-indigo-300 text-sm mb-1">Create Game #{currentGameId}</p>
+            <TransactionDefault 
+              calls={createGameCalls} 
+              chainId={BASE_SEPOLIA_CHAIN_ID}
+              className="w-full bg-blue-600 text-white font-bold py-2 px-6 rounded-lg hover:bg-blue-700 transition-all"
+            >
+            </TransactionDefault>
+          </div>
+          <div>
+            <p className="text-indigo-300 text-sm mb-1">Pay Entry Fee</p>
+            <TransactionDefault 
+              calls={joinGameCalls} 
+              chainId={BASE_SEPOLIA_CHAIN_ID} 
+              className="w-full bg-purple-600 text-white font-bold py-2 px-6 rounded-lg hover:bg-purple-700 transition-all"
+            >
+            </TransactionDefault>
+          </div>
+        </div>
+        
         {/* Updated chat container with ref */}
         <div 
           ref={chatContainerRef}
@@ -92,114 +92,6 @@ export default function JoinModal({ isOpen, onClose }: JoinModalProps) {
     }
   ] as const;
 
-  // Game contract ABI
-  const ContractAbi = [
-    {
-      type: 'constructor',
-      inputs: [
-        { internalType: 'address', name: '_usdcAddress', type: 'address' }
-      ],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'error',
-      name: 'OwnableInvalidOwner',
-      inputs: [
-        { internalType: 'address', name: 'owner', type: 'address' }
-      ],
-    },
-    {
-      type: 'error',
-      name: 'OwnableUnauthorizedAccount',
-      inputs: [
-        { internalType: 'address', name: 'account', type: 'address' }
-      ],
-    },
-    {
-      type: 'event',
-      name: 'GameCompleted',
-      anonymous: false,
-      inputs: [
-        { indexed: true, internalType: 'string', name: 'gameId', type: 'string' },
-        { indexed: false, internalType: 'address', name: 'aiPlayer', type: 'address' },
-        { indexed: false, internalType: 'address', name: 'mostVotedPlayer', type: 'address' },
-        { indexed: false, internalType: 'bool', name: 'correctlyIdentified', type: 'bool' }
-      ],
-    },
-    {
-      type: 'event',
-      name: 'GameCreated',
-      anonymous: false,
-      inputs: [
-        { indexed: true, internalType: 'string', name: 'gameId', type: 'string' }
-      ],
-    },
-    {
-      type: 'function',
-      name: 'ENTRY_FEE',
-      inputs: [],
-      outputs: [
-        { internalType: 'uint256', name: '', type: 'uint256' }
-      ],
-      stateMutability: 'view',
-    },
-    {
-      type: 'function',
-      name: 'adminClaimUnclaimedRewards',
-      inputs: [
-        { internalType: 'string', name: 'gameId', type: 'string' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'function',
-      name: 'createGame',
-      inputs: [
-        { internalType: 'string', name: 'gameId', type: 'string' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'function',
-      name: 'endGame',
-      inputs: [
-        { internalType: 'string', name: 'gameId', type: 'string' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'function',
-      name: 'joinGame',
-      inputs: [
-        { internalType: 'string', name: 'gameId', type: 'string' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'function',
-      name: 'vote',
-      inputs: [
-        { internalType: 'string', name: 'gameId', type: 'string' },
-        { internalType: 'address', name: 'votedFor', type: 'address' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-    {
-      type: 'function',
-      name: 'withdrawToken',
-      inputs: [
-        { internalType: 'address', name: 'tokenAddress', type: 'address' }
-      ],
-      outputs: [],
-      stateMutability: 'nonpayable',
-    },
-  ] as const;
-  
   // Create USDC approval call
   const approveCalls = [
     {
@@ -212,30 +104,6 @@ export default function JoinModal({ isOpen, onClose }: JoinModalProps) {
     }
   ];
 
-  // Create game call data
-  const createGameCalls = [
-    {
-      to: ContractAddress as `0x${string}`,
-      data: encodeFunctionData({
-        abi: ContractAbi,
-        functionName: 'createGame',
-        args: ['1']
-      }) as `0x${string}`,
-    }
-  ];
-
-  // Join game call data
-  const joinGameCalls = [
-    {
-      to: ContractAddress as `0x${string}`,
-      data: encodeFunctionData({
-        abi: ContractAbi,
-        functionName: 'joinGame',
-        args: ['1']
-      }) as `0x${string}`,
-    }
-  ];
-
   
   return (
     <div className="fixed inset-0 bg-black/80 flex items-center justify-center z-50 p-4">
@@ -272,14 +140,6 @@ export default function JoinModal({ isOpen, onClose }: JoinModalProps) {
         </div>
 
         <div className="mb-4">
-          <p>Create Game</p>
-          <TransactionDefault 
-            calls={createGameCalls} 
-            chainId={BASE_SEPOLIA_CHAIN_ID}
-            className="w-full bg-blue-600 text-white font-bold py-2 px-6 rounded-lg hover:bg-blue-700 transition-all mb-3"
-          >
-          </TransactionDefault>
-
           <p>Fund Wallet</p>
           <FundButton />
 
@@ -290,14 +150,6 @@ export default function JoinModal({ isOpen, onClose }: JoinModalProps) {
             className="w-full bg-green-600 text-white font-bold py-2 px-6 rounded-lg hover:bg-green-700 transition-all mb-3"
           >
           </TransactionDefault>
-
-          <p>Join Game</p>
-          <TransactionDefault 
-            calls={joinGameCalls} 
-            chainId={BASE_SEPOLIA_CHAIN_ID} 
-            className="w-full bg-purple-600 text-white font-bold py-2 px-6 rounded-lg hover:bg-purple-700 transition-all"
-          >
-          </TransactionDefault>
         </div>
 
         <button 
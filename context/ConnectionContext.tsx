@@ -1,6 +1,6 @@
 'use client';
 
-import { createContext, useContext, useState, useEffect, ReactNode } from 'react';
+import { createContext, useContext, useState, useEffect, useRef, ReactNode } from 'react';
 import { useGameState } from './GameStateContext';
 
 type ConnectionStatus = 'connecting' | 'online' | 'offline';
@@ -26,9 +26,17 @@ export const ConnectionProvider = ({
 }) => {
   const [socket, setSocket] = useState<WebSocket | null>(null);
   const [connectionStatus, setConnectionStatus] = useState<ConnectionStatus>('connecting');
-  const { updateGameState, addToast } = useGameState();
+  const { updateGameState, addToast, currentPlayer } = useGameState();
   const [reconnectAttempts, setReconnectAttempts] = useState(0);
   const [isInitialConnect, setIsInitialConnect] = useState(true);
+  // Delay the server asked for before reconnecting (it sends one when restarting)
+  const reconnectHintRef = useRef<number | null>(null);
+  // Latest player, so a reconnected socket can rejoin as them
+  const currentPlayerRef = useRef(currentPlayer);
+
+  useEffect(() => {
+    currentPlayerRef.current = currentPlayer;
+  }, [currentPlayer]);
 
   // Connect to WebSocket server
   useEffect(() => {
@@ -62,13 +70,26 @@ export const ConnectionProvider = ({
             type: 'getState'
           };
           newSocket.send(JSON.stringify(statePayload));
+          
+          // Rejoin as our player so the server puts us back in our game
+          if (currentPlayerRef.current) {
+            newSocket.send(JSON.stringify({
+              type: 'joinGame',
+              player: currentPlayerRef.current
+            }));
+          }
         };
         
         newSocket.onmessage = (event) => {
           try {
             const data = JSON.parse(event.data);
             console.log("Received from server:", data);
-            handleServerMessage(data);
+            // The server may batch several events into one array frame
+            if (Array.isArray(data)) {
+              data.forEach(handleServerMessage);
+            } else {
+              handleServerMessage(data);
+            }
           } catch (error) {
             console.error("Error parsing message from server:", error);
           }
@@ -78,6 +99,14 @@ export const ConnectionProvider = ({
           console.log("WebSocket connection closed");
           setConnectionStatus('offline');
           
+          // The server is restarting and told us when to come back
+          if (reconnectHintRef.current !== null) {
+            const hintedDelay = reconnectHintRef.current;
+            reconnectHintRef.current = null;
+            setTimeout(connectToServer, hintedDelay);
+            return;
+          }
+          
           // Only show disconnect toast if we were previously connected
           if (!isInitialConnect) {
             addToast('error', 'Disconnected from server. Attempting to reconnect...');
@@ -171,6 +200,11 @@ export const ConnectionProvider = ({
       case "pong":
         console.log("Server responded to ping");
         break;
+        
+      case "reconnect":
+        // Server is restarting, reconnect quietly after the delay it asked for
+        reconnectHintRef.current = data.retryAfterMs ?? 1000;
+        break;
     }
   };
 
@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import random
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from clocks import Clock
+from prompt_library import PromptLibrary
+from token_bucket import TokenBucket
+
+Room = Dict[str, Any]
+
+
+class AIScheduler:
+    """Central queue for AI turns across all rooms.
+
+    Each room has at most one turn queued or in flight. The heap key is
+    phaseEndsAt + silence_weight * aiLastSpokeAt: earlier deadlines and
+    longer silences come first, and because every room ages at the same rate
+    the key never has to change while a turn waits. A room whose AI hasn't
+    spoken yet this game sorts ahead of every room whose AI has.
+
+    The game supplies the hooks: `generate` produces a reply (or None if the
+    game has moved on), `send` posts it, `wants_turn` says whether a room
+    still needs a turn, `estimate_tokens` prices a request and `fallback`
+    gives a stock line when there is nothing cached to shed to.
+    """
+
+    def __init__(
+        self,
+        clock: Clock,
+        rng: random.Random,
+        generate: Callable[[Room], Awaitable[Optional[str]]],
+        send: Callable[[Room, str], Awaitable[None]],
+        wants_turn: Callable[[Room], bool],
+        estimate_tokens: Callable[[Room], float],
+        fallback: Callable[[], str],
+        requests_per_minute: float = 60,
+        tokens_per_minute: float = 40000,
+        max_concurrent: int = 4,
+        silence_weight: float = 1.0,
+        deadline_margin: float = 2.0,
+        reply_cache_size: int = 20,
+        record: Callable[[str, float], None] = lambda section, seconds: None,
+    ):
+        self.clock = clock
+        self.rng = rng
+        self.generate = generate
+        self.send = send
+        self.wants_turn = wants_turn
+        self.estimate_tokens = estimate_tokens
+        self.fallback = fallback
+        self.max_concurrent = max_concurrent
+        self.silence_weight = silence_weight
+        self.deadline_margin = deadline_margin
+        self.reply_cache_size = reply_cache_size
+        self.record = record                                  # Timing hook, e.g. Diagnostics.record
+        self.heap: List[Any] = []                             # (key, sequence, room id)
+        self.pending: Dict[str, Dict[str, Any]] = {}          # room id -> {'room', 'sequence', 'queuedAt'}
+        self.delayed: Set[str] = set()                        # Rooms with a turn waiting out its typing delay
+        self.in_flight: Set[str] = set()
+        self.sequence = 0
+        self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 6), clock)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 6, clock)
+        self.latency = 3.0                                    # Moving average of model call time, seconds
+        self.reply_cache: Dict[str, deque] = {}               # prompt digest -> recent generated replies
+        self.wakeup = asyncio.Event()
+        self.counts = Counter()                               # served / shed / dropped
+
+    def request(self, room: Room, delay: float = 0.0):
+        """Ask for an AI turn in a room, optionally after a typing delay. Extra requests while one is queued are merged."""
+        room_id = room['roomId']
+        if room_id in self.pending or room_id in self.in_flight or room_id in self.delayed or not self.wants_turn(room):
+            return
+        if delay > 0:
+            self.delayed.add(room_id)
+            asyncio.create_task(self._request_after(room, delay))
+            return
+        self.sequence += 1
+        key = (room['phaseEndsAt'] or float('inf')) + self.silence_weight * (room['aiLastSpokeAt'] or 0)
+        self.pending[room_id] = {'room': room, 'sequence': self.sequence, 'queuedAt': self.clock.monotonic()}
+        heapq.heappush(self.heap, (key, self.sequence, room_id))
+        self.wakeup.set()
+
+    async def _request_after(self, room: Room, delay: float):
+        await self.clock.sleep(delay)
+        self.delayed.discard(room['roomId'])
+        self.request(room)
+
+    def _slack(self, room: Room) -> float:
+        """Seconds left in the phase beyond what a model call needs"""
+        if not room['phaseEndsAt']:
+            return float('inf')
+        return room['phaseEndsAt'] - self.clock.time() - self.latency - self.deadline_margin
+
+    def _take(self, room_id: str) -> Dict[str, Any]:
+        # The heap entry is skipped lazily once it's gone from pending
+        return self.pending.pop(room_id)
+
+    def _sweep(self) -> float:
+        """Drop turns nobody needs any more and shed the ones out of time. Returns seconds until the next one runs out."""
+        next_expiry = float('inf')
+        for room_id, entry in list(self.pending.items()):
+            room = entry['room']
+            if not self.wants_turn(room):
+                self._take(room_id)
+                self.counts['dropped'] += 1
+                continue
+            slack = self._slack(room)
+            if slack <= 0:
+                self._take(room_id)
+                asyncio.create_task(self._shed(room))
+            else:
+                next_expiry = min(next_expiry, slack)
+        return next_expiry
+
+    async def run(self):
+        """Worker loop, started from main()"""
+        while True:
+            timeout = self._sweep()
+            while self.heap:
+                _, sequence, room_id = self.heap[0]
+                entry = self.pending.get(room_id)
+                if entry is not None and entry['sequence'] == sequence:
+                    break
+                heapq.heappop(self.heap)
+            
+            if self.heap and len(self.in_flight) < self.max_concurrent:
+                room_id = self.heap[0][2]
+                room = self.pending[room_id]['room']
+                cost = self.estimate_tokens(room)
+                wait = max(self.requests.time_until_available(), self.tokens.time_until_available(cost))
+                if wait <= 0:
+                    self.requests.consume()
+                    self.tokens.consume(cost)
+                    heapq.heappop(self.heap)
+                    entry = self._take(room_id)
+                    self.record('ai.queue', self.clock.monotonic() - entry['queuedAt'])
+                    self.in_flight.add(room_id)
+                    asyncio.create_task(self._serve(room))
+                    continue
+                timeout = min(timeout, wait)
+            
+            # Never spin on waits too short to change anything
+            timeout = max(timeout, 0.001)
+            self.wakeup.clear()
+            try:
+                if timeout == float('inf'):
+                    await self.wakeup.wait()
+                else:
+                    await self.clock.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _cache_key(self, room: Room) -> str:
+        return PromptLibrary.digest(room['aiPrompt'] or '').hex()
+
+    async def _serve(self, room: Room):
+        started = self.clock.monotonic()
+        try:
+            text = await self.generate(room)
+        finally:
+            self.in_flight.discard(room['roomId'])
+            self.latency = 0.8 * self.latency + 0.2 * (self.clock.monotonic() - started)
+            self.wakeup.set()
+        if text is None:
+            return
+        self.counts['served'] += 1
+        self.reply_cache.setdefault(self._cache_key(room), deque(maxlen=self.reply_cache_size)).append(text)
+        await self.send(room, text)
+
+    async def _shed(self, room: Room):
+        """Answer a turn without calling the model: a reply generated for this persona in another game, or a stock line"""
+        self.counts['shed'] += 1
+        said = {m['text'] for m in room['messages']}
+        cached = self.reply_cache.get(self._cache_key(room), ())
+        fresh = [text for text in cached if text not in said]
+        text = self.rng.choice(fresh) if fresh else self.fallback()
+        print(f"AI turn in game {room['roomId']} shed to a cached reply")
+        await self.send(room, text)
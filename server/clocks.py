@@ -0,0 +1,80 @@
+import asyncio
+import heapq
+import time
+from typing import Any, List
+
+
+class Clock:
+    """Wall-clock time and timers. Game code goes through `clock` so simulations can swap in virtual time."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    async def sleep(self, delay: float):
+        await asyncio.sleep(delay)
+
+    async def wait_for(self, awaitable, timeout: float):
+        return await asyncio.wait_for(awaitable, timeout)
+
+class VirtualClock(Clock):
+    """Virtual time for simulations.
+
+    Sleepers park on a heap of deadlines. The driver in run_until lets every
+    runnable task settle, then jumps straight to the earliest deadline, so a
+    minute of game time costs only the CPU needed to run it. Ties wake in the
+    order they were scheduled, which keeps runs reproducible.
+    """
+
+    def __init__(self, start: float, settle_yields: int = 16):
+        self.start = start
+        self.elapsed = 0.0           # Kept apart from start so short timers don't round away
+        self.settle_yields = settle_yields
+        self.timers: List[Any] = []  # heap of (deadline in elapsed seconds, sequence, future)
+        self.sequence = 0
+
+    def time(self) -> float:
+        return self.start + self.elapsed
+
+    def monotonic(self) -> float:
+        return self.elapsed
+
+    async def sleep(self, delay: float):
+        if delay <= 0:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.timers, (self.elapsed + delay, self.sequence, future))
+        await future
+
+    async def wait_for(self, awaitable, timeout: float):
+        task = asyncio.ensure_future(awaitable)
+        timer = asyncio.ensure_future(self.sleep(timeout))
+        await asyncio.wait({task, timer}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            timer.cancel()
+            return task.result()
+        task.cancel()
+        raise asyncio.TimeoutError()
+
+    async def _settle(self):
+        for _ in range(self.settle_yields):
+            await asyncio.sleep(0)
+
+    async def run_until(self, done, limit: float = float('inf')):
+        """Advance virtual time until done() is true, nothing is left to wake, or `limit` seconds have passed"""
+        while not done():
+            await self._settle()
+            if done():
+                break
+            # Drop timers whose sleeper was cancelled
+            while self.timers and self.timers[0][2].done():
+                heapq.heappop(self.timers)
+            if not self.timers or self.timers[0][0] > limit:
+                break
+            deadline, _, future = heapq.heappop(self.timers)
+            self.elapsed = max(self.elapsed, deadline)
+            future.set_result(None)
@@ -0,0 +1,58 @@
+import os
+from typing import Callable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows, where overlapping processes aren't supported anyway
+
+
+class GameIdCounter:
+    """Hands out game ids that are never reused.
+
+    Game ids name games in the archive, the stats and on-chain, so they must
+    stay unique across restarts and across the old and new process during a
+    graceful restart. The next id is kept in a small file that is locked while
+    it is read and bumped. When the file doesn't exist yet, `seed` is called
+    for the first id (for example one past the highest archived game). Without
+    a path ids are counted in memory, which is what simulations use.
+    """
+
+    def __init__(self, path: str = None, seed: Callable[[], int] = lambda: 1):
+        self.path = path
+        self.seed = seed
+        self.next_id = None  # In-memory counter, also the fallback if the file can't be used
+
+    def next(self) -> str:
+        """Reserve and return a new game id"""
+        if self.path:
+            try:
+                return str(self._next_from_file())
+            except OSError as e:
+                print(f"Could not update game id counter {self.path}, counting in memory: {e}")
+        if self.next_id is None:
+            self.next_id = self.seed()
+        game_id = self.next_id
+        self.next_id += 1
+        return str(game_id)
+
+    def _next_from_file(self) -> int:
+        with open(self.path, 'a+', encoding='utf-8') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)  # Released when the file is closed
+            f.seek(0)
+            stored = f.read().strip()
+            try:
+                game_id = int(stored) if stored else self.seed()
+            except ValueError:
+                print(f"Game id counter {self.path} is corrupt ({stored!r}), reseeding it")
+                game_id = self.seed()
+            if self.next_id is not None:
+                game_id = max(game_id, self.next_id)  # Don't reuse ids handed out while the file was unusable
+            f.seek(0)
+            f.truncate()
+            f.write(f"{game_id + 1}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.next_id = game_id + 1
+        return game_id
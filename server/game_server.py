@@ -1,13 +1,41 @@
 # This file is based on the original server.py
 # Save this file outside your Next.js project and run it separately
 
+import argparse
 import asyncio
+import contextlib
 import websockets
 import json
 import random
+import signal
+import socket
 import time
 import os
-from typing import Dict, List, Any, Set
+import sys
+import hashlib
+import hmac
+import threading
+import traceback
+import functools
+from collections import Counter, OrderedDict, deque
+from typing import Dict, List, Any, Set, Union
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Opcode
+from ai_scheduler import AIScheduler
+from clocks import Clock, VirtualClock
+from game_ids import GameIdCounter
+from prompt_library import PromptLibrary
+from settlement import SettlementQueue
+from timer_wheel import TimerWheel
+from token_bucket import TokenBucket
+from vote_tally import VoteTally
+from wire_format import compact_fields, expand_fields
+
+# MessagePack is optional, clients can only negotiate the binary protocol when it's installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Add OpenAI imports and setup
 from openai import AsyncOpenAI
@@ -78,51 +106,380 @@ def initialize_agent(ai_player_name, prompt):
         ), config
 
 
-# Game state
+# Time and randomness used by the game. Replaced by a VirtualClock and a seeded
+# Random in simulation mode (see run_simulation).
+clock = Clock()
+rng = random.Random()
+
+# Lobby state. Joining players wait here until matchmaking moves them into a
+# game room; every room has the same shape as this dict.
 game_state = {
+    'roomId': 'lobby',
     'players': [],
     'gameInProgress': False,
-    'nextGameTime': int(time.time() * 1000) + 30000,  # 30 seconds countdown
-    'currentGameId': "1",
+    'nextGameTime': None, # Estimated start of the next match, set by matchmaking
+    'currentGameId': None, # In the lobby, the id reserved for the next game (from game_ids)
     'messages': [],
-    'promptLibrary': [],  # Store submitted prompts
     'aiPlayer': None,     # Store the ID of the player controlled by AI
+    'aiPrompt': None,     # Persona prompt the AI plays for the whole game
+    'aiPlayerAddress': None,
     'votingOpen': False,  # Track if voting is currently open
     'votes': {},          # Track votes: {voter_id: voted_for_id}
-    'gameResults': None   # Results of the last game
+    'voteTally': None,    # Running VoteTally while voting is open
+    'votingClosed': None, # asyncio.Event set when every eligible player has voted
+    'gameResults': None,  # Results of the last game
+    'phaseEndsAt': None,  # When the current chat or voting phase ends (epoch seconds)
+    'aiLastSpokeAt': None, # When the AI last posted this game (epoch seconds), for scheduling
+    'closeAt': None       # When a finished room is closed (epoch seconds)
 }
 
+# Game rooms by game id, and the room each matched player is in.
+# Players that aren't in player_rooms are in the lobby.
+rooms: Dict[str, Dict[str, Any]] = {}
+player_rooms: Dict[str, Dict[str, Any]] = {}
+
+def new_room(game_id: str, players: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Create the state for a game room"""
+    return {
+        'roomId': game_id,
+        'players': players,
+        'gameInProgress': False,
+        'nextGameTime': None,
+        'currentGameId': game_id,
+        'messages': [],
+        'aiPlayer': None,
+        'aiPrompt': None,
+        'aiPlayerAddress': None,
+        'votingOpen': False,
+        'votes': {},
+        'voteTally': None,
+        'votingClosed': None,
+        'gameResults': None,
+        'phaseEndsAt': None,
+        'aiLastSpokeAt': None,
+        'closeAt': None
+    }
+
+def room_of(player_id: str) -> Dict[str, Any]:
+    """The room a player is in (the lobby if they haven't been matched)"""
+    return player_rooms.get(player_id, game_state)
+
+def room_for_connection(websocket) -> Dict[str, Any]:
+    """The room whose updates a socket should receive"""
+    for player_id in connection_players.get(websocket, ()):
+        room = player_rooms.get(player_id)
+        if room is not None:
+            return room
+    if not connection_players.get(websocket):
+        return rooms.get(spectator_rooms.get(websocket), game_state)
+    return game_state
+
+def room_closed(room: Dict[str, Any]) -> bool:
+    """Whether a game room has been closed (or reset) under a running game task"""
+    return rooms.get(room['roomId']) is not room
+
 # Connected clients
 clients: Set[websockets.WebSocketServerProtocol] = set()
 
-def print_game_state():
+# Liveness settings (seconds)
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 10))  # How often the server pings each client
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", 30))    # Close a socket that hasn't been heard from in this long
+RECONNECT_GRACE = float(os.environ.get("RECONNECT_GRACE", 15))        # How long a disconnected player is kept before reaping
+
+# Liveness tracking
+connection_last_seen: Dict[websockets.WebSocketServerProtocol, float] = {}       # socket -> last frame/pong (monotonic)
+connection_players: Dict[websockets.WebSocketServerProtocol, Set[str]] = {}      # socket -> player ids joined through it
+player_connections: Dict[str, websockets.WebSocketServerProtocol] = {}           # player id -> socket it's bound to
+
+# Wire protocols, negotiated through the WebSocket subprotocol at connect time.
+# Clients that don't ask for one get plain JSON.
+SUBPROTOCOL_JSON = "botornot.json"
+SUBPROTOCOL_MSGPACK = "botornot.msgpack.v1"
+SUPPORTED_SUBPROTOCOLS = [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON] if msgpack else [SUBPROTOCOL_JSON]
+
+# permessage-deflate tuning. Smaller windows and no context takeover cost
+# compression ratio but save memory per connection; the size threshold
+# skips compressing frames too small to benefit.
+WS_COMPRESSION = os.environ.get("WS_COMPRESSION", "deflate")  # "deflate" or "none"
+WS_DEFLATE_CONTEXT_TAKEOVER = os.environ.get("WS_DEFLATE_CONTEXT_TAKEOVER", "1") == "1"
+WS_DEFLATE_SERVER_MAX_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_SERVER_MAX_WINDOW_BITS", 12))
+WS_DEFLATE_CLIENT_MAX_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_CLIENT_MAX_WINDOW_BITS", 15))
+WS_DEFLATE_MEM_LEVEL = int(os.environ.get("WS_DEFLATE_MEM_LEVEL", 5))
+WS_DEFLATE_LEVEL = int(os.environ.get("WS_DEFLATE_LEVEL", 6))
+WS_COMPRESS_MIN_SIZE = int(os.environ.get("WS_COMPRESS_MIN_SIZE", 0))  # Bytes
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that sends messages below `min_size` uncompressed"""
+
+    def __init__(self, *args, min_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        # RFC 7692 allows any message to go out uncompressed (RSV1 unset), and
+        # skipping one leaves the compression context untouched
+        if (frame.opcode in (Opcode.TEXT, Opcode.BINARY) and frame.fin
+                and len(frame.data) < self.min_size):
+            return frame
+        return super().encode(frame)
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    """Server deflate factory that negotiates ThresholdPerMessageDeflate"""
+
+    def __init__(self, *args, min_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+            min_size=self.min_size,
+        )
+
+def get_compression_extensions():
+    """Build the permessage-deflate factory from config, or no extensions when disabled"""
+    if WS_COMPRESSION == "none":
+        return []
+    return [ThresholdDeflateFactory(
+        server_no_context_takeover=not WS_DEFLATE_CONTEXT_TAKEOVER,
+        server_max_window_bits=WS_DEFLATE_SERVER_MAX_WINDOW_BITS,
+        client_max_window_bits=WS_DEFLATE_CLIENT_MAX_WINDOW_BITS,
+        compress_settings={'memLevel': WS_DEFLATE_MEM_LEVEL, 'level': WS_DEFLATE_LEVEL},
+        min_size=WS_COMPRESS_MIN_SIZE,
+    )]
+
+# Outbound batching. When enabled, broadcasts are collected for this many
+# milliseconds and sent as a single JSON array frame. 0 sends every event immediately.
+BROADCAST_BATCH_MS = float(os.environ.get("BROADCAST_BATCH_MS", 0))
+# Message type -> earlier message types in the same batch it makes redundant
+SUPERSEDED_BY = {
+    'gameState': {'gameState', 'playersUpdate'},
+    'playersUpdate': {'playersUpdate'},
+}
+pending_batches: Dict[Any, List[Dict[str, Any]]] = {}  # room id (None for global) -> queued messages
+batch_flush_tasks: Dict[Any, asyncio.Task] = {}
+
+# Spectators are sockets without a player. They watch one room at lower priority:
+# their updates are coalesced and sent at most every SPECTATOR_UPDATE_MS, after
+# the players have been served, and are dropped for spectators that can't keep up.
+SPECTATOR_UPDATE_MS = float(os.environ.get("SPECTATOR_UPDATE_MS", 1000))
+SPECTATOR_MAX_MESSAGES = int(os.environ.get("SPECTATOR_MAX_MESSAGES", 20))        # Chat messages kept per update, newest win
+SPECTATOR_MAX_BUFFER = int(os.environ.get("SPECTATOR_MAX_BUFFER", 32 * 1024))   # Bytes unsent before a spectator's frames are dropped
+room_spectators: Dict[Any, Set[websockets.WebSocketServerProtocol]] = {}         # room id -> watching sockets
+spectator_rooms: Dict[websockets.WebSocketServerProtocol, Any] = {}              # socket -> room id it watches
+spectator_feeds: Dict[Any, List[Dict[str, Any]]] = {}                             # room id (None for global) -> queued messages
+spectator_flush_tasks: Dict[Any, asyncio.Task] = {}
+spectators_behind: Set[websockets.WebSocketServerProtocol] = set()               # dropped frames, next update is a full state
+
+# Deadlines for reaping players that have gone quiet or disconnected
+reaper_wheel = TimerWheel(resolution=1.0, now=clock.monotonic())
+
+# Inbound rate limits: message type -> (tokens refilled per second, burst size)
+RATE_LIMITS = {
+    'chatMessage': (1.0, 5),
+    'vote': (1.0, 5),
+    'joinGame': (0.2, 3),
+    'playerLeft': (0.2, 3),
+    'submitPrompt': (0.2, 3),
+    'createGame': (0.1, 2),
+    'reset': (0.05, 1),
+    'getState': (1.0, 5),
+    'ping': (1.0, 5),
+    'spectate': (0.5, 3),
+    'diagnostics': (0.5, 3),
+    'getStats': (1.0, 5),
+}
+DEFAULT_RATE_LIMIT = (2.0, 10)
+# Overall frame budget per socket. Past this we stop reading from the socket
+# instead of buffering, so the kernel pushes back on the sender.
+CONNECTION_RATE = float(os.environ.get("CONNECTION_RATE", 10))
+CONNECTION_BURST = float(os.environ.get("CONNECTION_BURST", 20))
+INBOUND_MAX_QUEUE = int(os.environ.get("INBOUND_MAX_QUEUE", 16))          # Frames websockets buffers before it stops reading
+INBOUND_MAX_FRAME_BYTES = int(os.environ.get("INBOUND_MAX_FRAME_BYTES", 65536))
+THROTTLE_NOTICE_INTERVAL = 1.0  # Don't send more than one throttle notice per second per socket
+
+# Rate limiter state
+connection_buckets: Dict[websockets.WebSocketServerProtocol, TokenBucket] = {}                  # socket -> overall frame budget
+connection_type_buckets: Dict[websockets.WebSocketServerProtocol, Dict[str, TokenBucket]] = {}  # socket -> type -> bucket
+player_type_buckets: Dict[str, Dict[str, TokenBucket]] = {}                                     # player id -> type -> bucket
+throttle_notified: Dict[websockets.WebSocketServerProtocol, float] = {}                         # socket -> last throttle notice
+
+def print_game_state(room=None):
     """Debug function to print game state"""
-    print("\n===== GAME STATE =====")
-    print(f"Total players: {len(game_state['players'])}")
-    print(f"Players: {', '.join(p['name'] for p in game_state['players'])}")
-    print(f"Game in progress: {game_state['gameInProgress']}")
-    print(f"Next game time: {time.strftime('%H:%M:%S', time.localtime(game_state['nextGameTime']/1000))}")
-    print(f"Game ID: {game_state['currentGameId']}")
-    print(f"AI Player: {game_state['aiPlayer']}")
-    print(f"Voting Open: {game_state['votingOpen']}")
+    room = room or game_state
+    print(f"\n===== GAME STATE ({room['roomId']}) =====")
+    print(f"Total players: {len(room['players'])}")
+    print(f"Players: {', '.join(p['name'] for p in room['players'])}")
+    print(f"Game in progress: {room['gameInProgress']}")
+    if room['nextGameTime']:
+        print(f"Next game time: {time.strftime('%H:%M:%S', time.localtime(room['nextGameTime']/1000))}")
+    print(f"Game ID: {room['currentGameId']}")
+    print(f"AI Player: {room['aiPlayer']}")
+    print(f"Voting Open: {room['votingOpen']}")
+    if room is game_state:
+        print(f"Active rooms: {len(rooms)}")
     print("=====================\n")
 
-async def broadcast(message: Dict[str, Any]):
-    """Broadcast a message to all connected clients"""
+def room_recipients(room=None):
+    """Player sockets that should receive a room's broadcasts (every player socket when room is None)"""
+    if room is None:
+        return set(player_connections.values())
+    return {player_connections[p['id']] for p in room['players'] if p['id'] in player_connections}
+
+def spectator_recipients(room=None):
+    """Sockets watching a room without a player of their own (every spectator when room is None)"""
+    if room is None:
+        watching = spectator_rooms.keys()
+    else:
+        watching = room_spectators.get(room['roomId'], ())
+    return {c for c in watching if not connection_players.get(c)}
+
+def spectate(websocket, room: Dict[str, Any]):
+    """Make a socket watch a room"""
+    unspectate(websocket)
+    spectator_rooms[websocket] = room['roomId']
+    room_spectators.setdefault(room['roomId'], set()).add(websocket)
+
+def unspectate(websocket):
+    """Stop a socket watching whichever room it watches"""
+    room_id = spectator_rooms.pop(websocket, None)
+    watching = room_spectators.get(room_id)
+    if watching is not None:
+        watching.discard(websocket)
+        if not watching:
+            del room_spectators[room_id]
+    spectators_behind.discard(websocket)
+
+async def broadcast(message: Dict[str, Any], room=None):
+    """Broadcast a message to a room's clients, or to all connected clients"""
     if not clients:
         return
     
-    message_str = json.dumps(message)
-    
-    print(f"Broadcasting {message.get('type')} to {len(clients)} clients")
+    print(f"Broadcasting {message.get('type')} to {'all' if room is None else room['roomId']} clients")
     
     if message.get('type') in ['playersUpdate', 'gameState']:
         print(f"Message includes {len(message.get('players', message.get('data', {}).get('players', []))) or 0} players")
     
+    # Spectators are served from their own, slower feed
+    if spectator_recipients(room):
+        queue_spectator_update(message, room)
+    
+    if BROADCAST_BATCH_MS > 0:
+        queue_broadcast(message, room)
+        return
+    
+    await send_to_clients(message, room_recipients(room))
+
+def queue_broadcast(message: Dict[str, Any], room=None):
+    """Add a message to the room's pending outbound batch, dropping any frames it supersedes"""
+    key = None if room is None else room['roomId']
+    pending = pending_batches.setdefault(key, [])
+    
+    superseded = SUPERSEDED_BY.get(message.get('type'))
+    if superseded:
+        pending[:] = [m for m in pending if m.get('type') not in superseded]
+    pending.append(message)
+    
+    # The first message in a window schedules the flush
+    if key not in batch_flush_tasks or batch_flush_tasks[key].done():
+        batch_flush_tasks[key] = asyncio.create_task(flush_batch_after_window(key, room))
+
+async def flush_batch_after_window(key, room):
+    """Send everything queued for a room during the batching window as one frame"""
+    await clock.sleep(BROADCAST_BATCH_MS / 1000)
+    
+    batch = pending_batches.pop(key, [])
+    batch_flush_tasks.pop(key, None)
+    if not batch:
+        return
+    
+    # A lone message goes out as a plain frame, same as without batching
+    await send_to_clients(batch[0] if len(batch) == 1 else batch, room_recipients(room))
+
+def queue_spectator_update(message: Dict[str, Any], room=None):
+    """Add a message to the room's spectator feed, keeping only what a spectator needs to catch up"""
+    key = None if room is None else room['roomId']
+    feed = spectator_feeds.setdefault(key, [])
+    
+    superseded = SUPERSEDED_BY.get(message.get('type'))
+    if superseded:
+        feed[:] = [m for m in feed if m.get('type') not in superseded]
+    feed.append(message)
+    
+    # Sample chat, the newest messages win
+    chat = [m for m in feed if m.get('type') == 'newMessage']
+    if len(chat) > SPECTATOR_MAX_MESSAGES:
+        dropped = {id(m) for m in chat[:len(chat) - SPECTATOR_MAX_MESSAGES]}
+        feed[:] = [m for m in feed if id(m) not in dropped]
+    
+    if key not in spectator_flush_tasks or spectator_flush_tasks[key].done():
+        spectator_flush_tasks[key] = asyncio.create_task(flush_spectator_feed(key, room))
+
+async def flush_spectator_feed(key, room):
+    """Send a room's coalesced spectator feed, one shared encoding per wire protocol"""
+    await clock.sleep(SPECTATOR_UPDATE_MS / 1000)
+    
+    feed = spectator_feeds.pop(key, [])
+    spectator_flush_tasks.pop(key, None)
+    recipients = spectator_recipients(room)
+    if not feed or not recipients or (room is not None and room is not game_state and room_closed(room)):
+        return
+    
+    update = feed[0] if len(feed) == 1 else feed
+    encoded_frames = {}
+    sends = []
+    for client in recipients:
+        # A spectator that can't keep up misses this update and gets a full state next time
+        if write_buffer_size(client) > SPECTATOR_MAX_BUFFER:
+            spectators_behind.add(client)
+            continue
+        
+        if client in spectators_behind:
+            spectators_behind.discard(client)
+            watched = room_for_connection(client)
+            cache_key = (client.subprotocol, watched['roomId'])
+            if cache_key not in encoded_frames:
+                encoded_frames[cache_key] = encode_frame({
+                    'type': 'gameState',
+                    'data': get_client_game_state(watched)
+                }, client.subprotocol)
+        else:
+            cache_key = (client.subprotocol, None)
+            if cache_key not in encoded_frames:
+                encoded_frames[cache_key] = encode_frame(update, client.subprotocol)
+        sends.append(send_to_spectator(client, encoded_frames[cache_key]))
+    
+    await asyncio.gather(*sends)
+
+async def send_to_spectator(websocket, frame: Union[str, bytes]):
+    """Send a pre-encoded frame to a spectator, dropping it if the socket is gone"""
+    try:
+        await websocket.send(frame)
+    except (websockets.ConnectionClosed, Exception):
+        clients.discard(websocket)
+        unspectate(websocket)
+
+def write_buffer_size(websocket) -> int:
+    """Bytes queued on a socket that the peer hasn't read yet"""
+    transport = getattr(websocket, 'transport', None)
+    return transport.get_write_buffer_size() if transport is not None else 0
+
+async def send_to_clients(message: Union[Dict[str, Any], List[Dict[str, Any]]], recipients):
+    """Send a message to the given clients, encoding it once per wire protocol"""
+    started = time.perf_counter()
+    encoded_frames = {}
     dead_clients = set()
-    for client in clients.copy():
+    for client in recipients:
+        protocol = client.subprotocol
+        if protocol not in encoded_frames:
+            encoded_frames[protocol] = encode_frame(message, protocol)
         try:
-            await client.send(message_str)
+            await client.send(encoded_frames[protocol])
         except (websockets.ConnectionClosed, Exception):
             dead_clients.add(client)
     
@@ -131,27 +488,226 @@ async def broadcast(message: Dict[str, Any]):
     
     if dead_clients:
         print(f"Removed {len(dead_clients)} dead clients. Total clients: {len(clients)}")
-
-async def generate_ai_response_with_agentkit(prompt, messages, ai_player_name):
-    """Generate a message for the AI player using AgentKit with streaming"""
-    global agent_executor, agent_config
     
-    try:
-        print(f"Generating AI response with AgentKit for player {ai_player_name} using prompt: {prompt}")
-        
-        if not agent_executor:
-            print("Agent not initialized, initializing now...")
-            initialize_agent(ai_player_name, prompt)
-            global agentInit
-            agentInit = True
-            print("Agent initialization complete")
-        
-        # Create the context for the agent
-        recent_messages = messages[-10:] if len(messages) > 10 else messages
-        print(f"Using {len(recent_messages)} recent messages for context")
+    diagnostics.record('broadcast', time.perf_counter() - started)
+
+def encode_frame(message, protocol) -> Union[str, bytes]:
+    """Encode a message for a connection's negotiated protocol"""
+    started = time.perf_counter()
+    if protocol == SUBPROTOCOL_MSGPACK:
+        frame = msgpack.packb(compact_fields(message), use_bin_type=True)
+    else:
+        frame = json.dumps(message)
+    diagnostics.record(f"encode.{protocol or SUBPROTOCOL_JSON}", time.perf_counter() - started)
+    return frame
+
+def decode_frame(frame: Union[str, bytes], protocol):
+    """Decode an inbound frame for a connection's negotiated protocol"""
+    if protocol == SUBPROTOCOL_MSGPACK and isinstance(frame, bytes):
+        return expand_fields(msgpack.unpackb(frame, raw=False, strict_map_key=False))
+    return json.loads(frame)
+
+async def send_message(websocket, message: Dict[str, Any]):
+    """Send a message to a single client in its negotiated protocol"""
+    await websocket.send(encode_frame(message, websocket.subprotocol))
+
+def touch_connection(websocket):
+    """Record activity on a socket and on every player joined through it"""
+    now = clock.monotonic()
+    connection_last_seen[websocket] = now
+    for player_id in connection_players.get(websocket, ()):
+        reaper_wheel.schedule(player_id, now + HEARTBEAT_TIMEOUT + RECONNECT_GRACE)
+
+def detach_player(websocket, player_id: str):
+    """Take a player off a socket. With no player left on it, the socket goes back to watching the lobby."""
+    connection_players.get(websocket, set()).discard(player_id)
+    if not connection_players.get(websocket) and websocket in clients:
+        spectate(websocket, game_state)
+        spectators_behind.add(websocket)
+
+def bind_player(websocket, player_id: str) -> bool:
+    """Associate a player with the socket they joined (or rejoined) from.
+
+    Player ids are public, so a player is only moved off a socket that has
+    closed or gone quiet. Returns False if their current socket is still live.
+    """
+    previous = player_connections.get(player_id)
+    if previous is not None and previous is not websocket:
+        last_seen = connection_last_seen.get(previous)
+        if previous in clients and last_seen is not None and clock.monotonic() - last_seen < HEARTBEAT_TIMEOUT:
+            return False
+        detach_player(previous, player_id)
+    player_connections[player_id] = websocket
+    connection_players.setdefault(websocket, set()).add(player_id)
+    touch_connection(websocket)
+    return True
+
+def unbind_player(player_id: str):
+    """Stop tracking liveness for a player"""
+    websocket = player_connections.pop(player_id, None)
+    if websocket is not None:
+        detach_player(websocket, player_id)
+    player_type_buckets.pop(player_id, None)
+    reaper_wheel.cancel(player_id)
+
+def release_connection(websocket):
+    """Forget a closed socket, giving its players a grace period to reconnect"""
+    connection_last_seen.pop(websocket, None)
+    connection_buckets.pop(websocket, None)
+    connection_type_buckets.pop(websocket, None)
+    throttle_notified.pop(websocket, None)
+    unspectate(websocket)
+    deadline = clock.monotonic() + RECONNECT_GRACE
+    for player_id in connection_players.pop(websocket, set()):
+        if player_connections.get(player_id) is websocket:
+            del player_connections[player_id]
+            reaper_wheel.schedule(player_id, deadline)
+            print(f"Player {player_id} disconnected, reaping in {RECONNECT_GRACE:.0f}s unless they reconnect")
+
+def is_player_connected(player_id: str) -> bool:
+    """Whether a player currently has a live socket"""
+    return player_id in player_connections
+
+def remove_player(player_id: str):
+    """Remove a player from whichever room they're in. Returns the removed player or None."""
+    room = room_of(player_id)
+    unbind_player(player_id)
+    player_rooms.pop(player_id, None)
+    matchmaking_queue.pop(player_id, None)
+    if room['votingOpen'] and room['voteTally']:
+        room['voteTally'].remove_voter(player_id)
+    player_index = next((i for i, p in enumerate(room['players']) if p['id'] == player_id), -1)
+    if player_index == -1:
+        return None
+    return room['players'].pop(player_index)
+
+async def reap_players(player_ids: List[str]):
+    """Remove players whose liveness deadline has passed"""
+    now = clock.monotonic()
+    affected_rooms = {}
+    for player_id in player_ids:
+        room = room_of(player_id)
         
-        # Format the system prompt
-        system_prompt = f"""You are playing a game called 'Find the AI' where humans try to identify which player is an AI.
+        # The AI plays on behalf of this player, keep them until the game is over
+        if room['gameInProgress'] and player_id == room['aiPlayer']:
+            reaper_wheel.schedule(player_id, now + RECONNECT_GRACE)
+            continue
+
+        removed_player = remove_player(player_id)
+        if removed_player:
+            print(f"Reaped stale player {removed_player['name']} from {room['roomId']}")
+            affected_rooms[room['roomId']] = room
+
+    for room in affected_rooms.values():
+        await broadcast({
+            'type': 'playersUpdate',
+            'players': [scrub_player_data(p, room) for p in room['players']]
+        }, room)
+
+        # A ghost may have been the last voter we were waiting on
+        check_voting_complete(room)
+    
+    if game_state['roomId'] in affected_rooms:
+        update_lobby_countdown()
+
+def message_player_id(data: Dict[str, Any]):
+    """Best-effort lookup of the player a message acts on behalf of"""
+    if isinstance(data.get('player'), dict):
+        return data['player'].get('id')
+    if isinstance(data.get('message'), dict):
+        return data['message'].get('senderId')
+    return data.get('voterId') or data.get('playerId')
+
+def _take_type_token(buckets: Dict[str, TokenBucket], message_type: str) -> bool:
+    bucket = buckets.get(message_type)
+    if bucket is None:
+        rate, burst = RATE_LIMITS.get(message_type, DEFAULT_RATE_LIMIT)
+        bucket = buckets[message_type] = TokenBucket(rate, burst, clock)
+    return bucket.consume()
+
+def allow_message(websocket, data: Dict[str, Any]) -> bool:
+    """Check the per-connection and per-player limits for this message type"""
+    message_type = str(data.get('type'))
+    if not _take_type_token(connection_type_buckets.setdefault(websocket, {}), message_type):
+        return False
+    
+    # Only charge a player's budget for messages from their own socket, or
+    # anyone could use up another player's allowance by naming them
+    player_id = message_player_id(data)
+    if player_id and player_id in connection_players.get(websocket, ()):
+        if not _take_type_token(player_type_buckets.setdefault(player_id, {}), message_type):
+            return False
+    return True
+
+async def apply_backpressure(websocket):
+    """Wait for the socket's overall frame budget instead of reading further.
+
+    While we sleep here the socket isn't read, websockets stops pulling from the
+    transport once its queue is full and TCP flow control slows the sender down.
+    """
+    bucket = connection_buckets.get(websocket)
+    if bucket is None:
+        bucket = connection_buckets[websocket] = TokenBucket(CONNECTION_RATE, CONNECTION_BURST, clock)
+    
+    while not bucket.consume():
+        await clock.sleep(bucket.time_until_available())
+
+async def send_throttled_notice(websocket, message_type: str):
+    """Tell a client it's being throttled, at most once per notice interval"""
+    now = clock.monotonic()
+    if now - throttle_notified.get(websocket, 0.0) < THROTTLE_NOTICE_INTERVAL:
+        return
+    throttle_notified[websocket] = now
+    
+    await send_message(websocket, {
+        'type': 'errorMessage',
+        'message': "You're sending messages too fast. Please slow down.",
+        'throttled': message_type
+    })
+
+async def heartbeat_loop():
+    """Ping every client periodically and close sockets that stopped answering"""
+    while True:
+        await clock.sleep(HEARTBEAT_INTERVAL)
+        now = clock.monotonic()
+
+        for websocket in list(clients):
+            last_seen = connection_last_seen.get(websocket, now)
+            if now - last_seen > HEARTBEAT_TIMEOUT:
+                print(f"Closing unresponsive connection (silent for {now - last_seen:.0f}s)")
+                asyncio.create_task(websocket.close())
+                continue
+
+            try:
+                pong_waiter = await websocket.ping()
+            except Exception:
+                continue
+            pong_waiter.add_done_callback(
+                lambda f, ws=websocket: touch_connection(ws) if not f.cancelled() and f.exception() is None else None
+            )
+
+async def reaper_loop():
+    """Drive the reaper wheel and remove players whose deadline has passed"""
+    while True:
+        await clock.sleep(reaper_wheel.resolution)
+        expired = reaper_wheel.advance(clock.monotonic())
+        if expired:
+            await reap_players(expired)
+
+# Prompt library settings
+PROMPT_LIBRARY_PATH = os.environ.get(
+    "PROMPT_LIBRARY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_library.json")
+)
+PROMPT_LIBRARY_MAX = int(os.environ.get("PROMPT_LIBRARY_MAX", 1000))  # Oldest prompts are evicted past this
+PROMPT_LIBRARY_SAVE_DELAY = 2.0  # Seconds to coalesce writes after a change
+DEFAULT_PROMPT = "Be a normal, friendly person chatting with others."
+
+prompt_library = PromptLibrary(PROMPT_LIBRARY_PATH, PROMPT_LIBRARY_MAX, PROMPT_LIBRARY_SAVE_DELAY)
+
+@functools.lru_cache(maxsize=64)
+def render_system_prompt(ai_player_name, prompt):
+    """Render the AI's system prompt for a persona"""
+    return f"""You are playing a game called 'Find the AI' where humans try to identify which player is an AI.
             You are playing as {ai_player_name}, an AI pretending to be a human based on this prompt: "{prompt}".
             
             CRITICAL INSTRUCTION: Your ENTIRE response must be EXACTLY the message text ONLY.
@@ -174,7 +730,51 @@ async def generate_ai_response_with_agentkit(prompt, messages, ai_player_name):
             CORRECT OUTPUT: "hey what's up"
             
             Remember that ANY letter or name followed by a colon at the start of your message is FORBIDDEN.
-        """
+            """
+
+def collect_agent_stream(executor, inputs, config, response_chunks):
+    """Run the agent and collect the content of its streamed chunks (blocking, runs in an executor)"""
+    stream_result = executor.stream(inputs, config)
+    
+    chunk_count = 0
+    print("Processing stream chunks:")
+    for chunk in stream_result:
+        chunk_count += 1
+        print(f"Received chunk {chunk_count}: {chunk}")
+        
+        if "agent" in chunk and "messages" in chunk["agent"] and len(chunk["agent"]["messages"]) > 0:
+            content = chunk["agent"]["messages"][0].content
+            print(f"Extracted agent content: {content}")
+            response_chunks.append(content)
+        elif "tools" in chunk and "messages" in chunk["tools"] and len(chunk["tools"]["messages"]) > 0:
+            content = chunk["tools"]["messages"][0].content
+            print(f"Extracted tools content: {content}")
+            response_chunks.append(content)
+        else:
+            print(f"Chunk has no recognizable content format: {chunk}")
+    
+    print(f"Processed {chunk_count} chunks, collected {len(response_chunks)} content pieces")
+
+async def generate_ai_response_with_agentkit(prompt, messages, ai_player_name, ai_player_id, thread_id=None):
+    """Generate a message for the AI player using AgentKit with streaming"""
+    global agent_executor, agent_config
+    
+    try:
+        print(f"Generating AI response with AgentKit for player {ai_player_name} using prompt: {prompt}")
+        
+        if not agent_executor:
+            print("Agent not initialized, initializing now...")
+            await asyncio.get_running_loop().run_in_executor(None, initialize_agent, ai_player_name, prompt)
+            global agentInit
+            agentInit = True
+            print("Agent initialization complete")
+        
+        # Create the context for the agent
+        recent_messages = messages[-10:] if len(messages) > 10 else messages
+        print(f"Using {len(recent_messages)} recent messages for context")
+        
+        # Format the system prompt (rendered once per persona and cached)
+        system_prompt = render_system_prompt(ai_player_name, prompt)
         
         # Create the message list for the agent - using proper imports
         from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
@@ -183,7 +783,7 @@ async def generate_ai_response_with_agentkit(prompt, messages, ai_player_name):
         
         # Add recent chat history for context
         for msg in recent_messages:
-            if msg.get('senderId') != game_state['aiPlayer']:
+            if msg.get('senderId') != ai_player_id:
                 # Add human messages
                 message_list.append(HumanMessage(content=f"A player named {msg.get('senderName')} said: {msg.get('text')}"))
             else:
@@ -202,29 +802,13 @@ async def generate_ai_response_with_agentkit(prompt, messages, ai_player_name):
         # Here's the key change - using the streaming approach from the Flask route example
         try:
             print("Sending request to agent_executor.stream")
-            stream_result = agent_executor.stream(
-                {"messages": message_list}, 
-                agent_config
+            # Each game gets its own conversation thread in the agent's memory
+            config = {"configurable": {"thread_id": thread_id}} if thread_id else agent_config
+            # The agent's stream is a blocking iterator, so it is consumed on a
+            # worker thread and the event loop keeps serving other games meanwhile
+            await asyncio.get_running_loop().run_in_executor(
+                None, collect_agent_stream, agent_executor, {"messages": message_list}, config, response_chunks
             )
-            
-            chunk_count = 0
-            print("Processing stream chunks:")
-            for chunk in stream_result:
-                chunk_count += 1
-                print(f"Received chunk {chunk_count}: {chunk}")
-                
-                if "agent" in chunk and "messages" in chunk["agent"] and len(chunk["agent"]["messages"]) > 0:
-                    content = chunk["agent"]["messages"][0].content
-                    print(f"Extracted agent content: {content}")
-                    response_chunks.append(content)
-                elif "tools" in chunk and "messages" in chunk["tools"] and len(chunk["tools"]["messages"]) > 0:
-                    content = chunk["tools"]["messages"][0].content
-                    print(f"Extracted tools content: {content}")
-                    response_chunks.append(content)
-                else:
-                    print(f"Chunk has no recognizable content format: {chunk}")
-            
-            print(f"Processed {chunk_count} chunks, collected {len(response_chunks)} content pieces")
         
         except Exception as stream_error:
             print(f"Error in stream processing: {stream_error}")
@@ -278,30 +862,7 @@ def initialize_agent(ai_player_name, prompt):
         config = {"configurable": {"thread_id": "Find the AI Game Agent"}}
         
         # Create the agent prompt
-        initial_prompt = f"""You are playing a game called 'Find the AI' where humans try to identify which player is an AI.
-                You are playing as {ai_player_name}, an AI pretending to be a human based on this prompt: "{prompt}".
-                
-                CRITICAL INSTRUCTION: Your ENTIRE response must be EXACTLY the message text ONLY.
-                DO NOT include ANY prefixes like "j:", "l:", "{ai_player_name}:", or any letter/name followed by a colon.
-                
-                Write a single message that seems natural and human-like according to the character described in the prompt.
-                Keep your response short (1-2 sentences).
-                Don't be too formal or perfect in your response. Avoid proper capitalization and punctuation, unless the description 
-                of your persona specifically calls for you to be formal. Don't give away the fact that you're AI. 
-                Use casual language, slang, or make small typos to seem more human.
-                Don't introduce yourself or say hello if the conversation is already ongoing.
-                Act like the human described in the prompt.
-                
-                INCORRECT OUTPUT: "j: just vibing, you know!"
-                INCORRECT OUTPUT: "l: life back then was tough"
-                INCORRECT OUTPUT: "{ai_player_name}: hey what's up"
-                
-                CORRECT OUTPUT: "just vibing, you know!"
-                CORRECT OUTPUT: "life back then was tough"
-                CORRECT OUTPUT: "hey what's up"
-                
-                Remember that ANY letter or name followed by a colon at the start of your message is FORBIDDEN.
-                """
+        initial_prompt = render_system_prompt(ai_player_name, prompt)
 
         print("Creating ReAct Agent...")
         # Create ReAct Agent
@@ -323,7 +884,7 @@ def initialize_agent(ai_player_name, prompt):
         traceback.print_exc()
         return None, None
 
-async def generate_ai_response(prompt, messages, ai_player_name):
+async def generate_ai_response(prompt, messages, ai_player_name, ai_player_id, thread_id=None):
     """Generate a message for the AI player"""
     try:
         print(f"Starting AI response generation for player {ai_player_name}")
@@ -331,7 +892,7 @@ async def generate_ai_response(prompt, messages, ai_player_name):
         # Try to use the AgentKit integration
         try:
             print("Attempting to use AgentKit for response generation")
-            agentkit_response = await generate_ai_response_with_agentkit(prompt, messages, ai_player_name)
+            agentkit_response = await generate_ai_response_with_agentkit(prompt, messages, ai_player_name, ai_player_id, thread_id)
             if agentkit_response:
                 print(f"AgentKit response successful: {agentkit_response}")
                 return agentkit_response
@@ -355,36 +916,13 @@ async def generate_ai_response(prompt, messages, ai_player_name):
         # System prompt to set up the context
         system_prompt = {
             "role": "system", 
-            "content": f"""You are playing a game called 'Find the AI' where humans try to identify which player is an AI.
-            You are playing as {ai_player_name}, an AI pretending to be a human based on this prompt: "{prompt}".
-            
-            CRITICAL INSTRUCTION: Your ENTIRE response must be EXACTLY the message text ONLY.
-            DO NOT include ANY prefixes like "j:", "l:", "{ai_player_name}:", or any letter/name followed by a colon.
-            
-            Write a single message that seems natural and human-like according to the character described in the prompt.
-            Keep your response short (1-2 sentences).
-            Don't be too formal or perfect in your response. Avoid proper capitalization and punctuation, unless the description 
-            of your persona specifically calls for you to be formal. Don't give away the fact that you're AI. 
-            Use casual language, slang, or make small typos to seem more human.
-            Don't introduce yourself or say hello if the conversation is already ongoing.
-            Act like the human described in the prompt.
-            
-            INCORRECT OUTPUT: "j: just vibing, you know!"
-            INCORRECT OUTPUT: "l: life back then was tough"
-            INCORRECT OUTPUT: "{ai_player_name}: hey what's up"
-            
-            CORRECT OUTPUT: "just vibing, you know!"
-            CORRECT OUTPUT: "life back then was tough"
-            CORRECT OUTPUT: "hey what's up"
-            
-            Remember that ANY letter or name followed by a colon at the start of your message is FORBIDDEN.
-            """
+            "content": render_system_prompt(ai_player_name, prompt)
         }
         message_history.append(system_prompt)
         
         # Add recent chat history for context
         for msg in recent_messages:
-            if msg.get('senderId') != game_state['aiPlayer']:
+            if msg.get('senderId') != ai_player_id:
                 # Format user messages differently to avoid teaching the pattern
                 message_history.append({
                     "role": "user",
@@ -430,79 +968,6 @@ async def generate_ai_response(prompt, messages, ai_player_name):
         traceback.print_exc()
         return get_fallback_ai_message()
 
-async def generate_and_send_ai_message():
-    """Generate and send a message from the AI-controlled player"""
-    global agentInit, agent_executor, agent_config
-    
-    try:
-        print("\n--- Starting AI message generation process ---")
-        
-        if not game_state['gameInProgress']:
-            print("No game in progress, skipping AI message")
-            return
-            
-        if not game_state['aiPlayer']:
-            print("No AI player assigned, skipping AI message")
-            return
-            
-        # Find AI player
-        ai_player = next((p for p in game_state['players'] if p['id'] == game_state['aiPlayer']), None)
-        if not ai_player:
-            print("Could not find AI player in players list")
-            return
-            
-        print(f"Generating message for AI player: {ai_player['name']} (ID: {ai_player['id']})")
-        
-        # Choose a random prompt from the library
-        if not game_state['promptLibrary']:
-            prompt = "Be a normal, friendly person chatting with others."
-            print("Using default prompt (no prompt library)")
-        else:
-            prompt = random.choice(game_state['promptLibrary'])
-            print(f"Using random prompt from library: {prompt}")
-            
-        # Initialize agent if not already done
-        if not agentInit:
-            print("Agent not initialized, initializing now...")
-            agent_executor, agent_config = initialize_agent(ai_player['name'], prompt)
-            agentInit = True
-            
-        # Generate AI message
-        print("Calling generate_ai_response to get message...")
-        ai_message = await generate_ai_response(prompt, game_state['messages'], ai_player['name'])
-        print(f"AI message generated: {ai_message}")
-        
-        if not ai_message or ai_message.strip() == "":
-            print("Empty message received, using fallback")
-            ai_message = get_fallback_ai_message()
-            
-        # Create message object
-        message_obj = {
-            'id': ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
-            'senderId': ai_player['id'],
-            'senderName': ai_player['name'],
-            'text': ai_message,
-            'timestamp': int(time.time() * 1000)
-        }
-        
-        # Store message in game state
-        game_state['messages'].append(message_obj)
-        
-        # Broadcast message to all clients
-        print("Broadcasting AI message to all clients")
-        await broadcast({
-            'type': 'newMessage',
-            'message': message_obj
-        })
-        
-        print(f"AI ({ai_player['name']}) said: {ai_message}")
-        print("--- AI message process complete ---\n")
-    
-    except Exception as e:
-        print(f"Error in generate_and_send_ai_message: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
-
 # Simpler fallback function
 def get_fallback_ai_message():
     """Return a fallback message if OpenAI API fails"""
@@ -518,439 +983,1472 @@ def get_fallback_ai_message():
         "I'm not very good at these kinds of games, but I'm enjoying it!",
         "Anyone have any good weekend plans? I'm thinking of checking out that new movie."
     ]
-    selected = random.choice(fallback_messages)
+    selected = rng.choice(fallback_messages)
     print(f"Using fallback message: {selected}")
     return selected
 
-async def handle_connection(websocket: websockets.WebSocketServerProtocol, path: str):
-    """Handle a new WebSocket connection"""
+# Inbound traffic can be recorded to a JSON lines file and replayed later
+# with `--simulate --replay <file>`.
+SESSION_RECORD_PATH = os.environ.get("SESSION_RECORD_PATH")
+session_record_file = None
+
+def record_inbound(client_id: str, data: Dict[str, Any]):
+    """Append a decoded inbound message to the session recording, if one is enabled"""
+    global session_record_file
+    if not SESSION_RECORD_PATH:
+        return
+    if data.get('type') == 'diagnostics':
+        # Admin requests carry the admin token and aren't part of the game
+        return
+    if session_record_file is None:
+        session_record_file = open(SESSION_RECORD_PATH, 'a', encoding='utf-8', buffering=1)
+    session_record_file.write(json.dumps({'t': clock.monotonic(), 'client': client_id, 'message': data}) + '\n')
+
+# Runtime diagnostics: event-loop lag sampling, a watchdog that captures the
+# stack of whatever is blocking the loop, timing per handler and per hot
+# section, and an on-demand sampling profiler. Controlled at runtime through
+# the admin-only 'diagnostics' message.
+DIAGNOSTICS_ENABLED = os.environ.get("DIAGNOSTICS", "1") == "1"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")                                # Unset disables the diagnostics message
+LAG_SAMPLE_INTERVAL = float(os.environ.get("LAG_SAMPLE_INTERVAL", 0.25))   # Seconds between event-loop lag samples
+SLOW_CALLBACK_MS = float(os.environ.get("SLOW_CALLBACK_MS", 100))          # Loop stalls longer than this get their stack captured
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))     # The profiler stops itself after this long
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+class Diagnostics:
+    """Loop lag, stall stacks, section timings and a sampling profiler.
+
+    The watchdog and the profiler run on their own threads and look at the
+    event loop thread through sys._current_frames(), so they still see it
+    when it is stuck in a blocking call.
+    """
+
+    def __init__(self):
+        self.loop_thread_id = None
+        self.last_tick = time.perf_counter()
+        self.lag_samples = deque(maxlen=240)                  # Most recent lag samples, in seconds
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=20)                        # Most recent stall reports
+        self.timings: Dict[str, List[float]] = {}             # section -> [count, total seconds, max seconds]
+        self.profile_counts: Counter = Counter()              # folded stack -> samples
+        self.profile_stop = None                              # threading.Event from start until stop_profile, set once sampling ends
+        self.profile_started = None
+
+    def record(self, section: str, seconds: float):
+        """Add one timing to a section's totals"""
+        stats = self.timings.get(section)
+        if stats is None:
+            self.timings[section] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+    def start(self):
+        """Start lag sampling and the stall watchdog on the running loop"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.perf_counter()
+        asyncio.create_task(self.sample_lag())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    async def sample_lag(self):
+        """Measure how late the loop wakes us up compared to when we asked"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            self.last_tick = time.perf_counter()
+            lag = max(0.0, self.last_tick - started - LAG_SAMPLE_INTERVAL)
+            self.lag_samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag * 1000 > SLOW_CALLBACK_MS:
+                print(f"Event loop lagged {lag * 1000:.0f}ms")
+
+    def _watchdog(self):
+        threshold = LAG_SAMPLE_INTERVAL + SLOW_CALLBACK_MS / 1000
+        reported_tick = None
+        while True:
+            time.sleep(SLOW_CALLBACK_MS / 2000)
+            tick = self.last_tick
+            stalled_for = time.perf_counter() - tick
+            if stalled_for < threshold or tick == reported_tick:
+                continue
+            # Capture once per stall, while the loop is still stuck
+            reported_tick = tick
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            self.stalls.append({
+                'at': time.time(),
+                'stalledMs': round(stalled_for * 1000),
+                'stack': stack
+            })
+            print(f"Event loop blocked for {stalled_for * 1000:.0f}ms, currently in:\n{stack}")
+
+    @property
+    def profiling(self) -> bool:
+        return self.profile_stop is not None and not self.profile_stop.is_set()
+
+    def start_profile(self) -> bool:
+        """Start sampling the loop thread's stack. Returns False if already running."""
+        if self.profiling:
+            return False
+        self.profile_counts = Counter()
+        self.profile_stop = threading.Event()
+        self.profile_started = time.perf_counter()
+        threading.Thread(target=self._profile, args=(self.profile_stop,), name="sampling-profiler", daemon=True).start()
+        return True
+
+    def _profile(self, stop):
+        deadline = time.perf_counter() + PROFILE_MAX_SECONDS
+        while not stop.wait(PROFILE_INTERVAL_MS / 1000) and time.perf_counter() < deadline:
+            frame = sys._current_frames().get(self.loop_thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.profile_counts[';'.join(reversed(names))] += 1
+        if not stop.is_set():
+            # Hit PROFILE_MAX_SECONDS, the samples are kept until profileStop writes them
+            stop.set()
+            print(f"Profiler stopped after {PROFILE_MAX_SECONDS:.0f}s")
+
+    def stop_profile(self):
+        """Stop the profiler and write its samples in folded-stack format (for flamegraph.pl or speedscope)"""
+        if self.profile_stop is None:
+            return None
+        self.profile_stop.set()
+        self.profile_stop = None
+        path = os.path.join(PROFILE_OUTPUT_DIR, f"profile-{int(time.time())}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.profile_counts.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {sum(self.profile_counts.values())} profile samples to {path}")
+        return path
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current diagnostics, safe to send to an admin client"""
+        samples = sorted(self.lag_samples)
+        return {
+            'lagMs': {
+                'last': round(self.lag_samples[-1] * 1000, 2) if samples else None,
+                'p50': round(samples[len(samples) // 2] * 1000, 2) if samples else None,
+                'p99': round(samples[int(len(samples) * 0.99)] * 1000, 2) if samples else None,
+                'max': round(self.max_lag * 1000, 2),
+            },
+            'stalls': list(self.stalls),
+            'timings': {
+                section: {
+                    'count': count,
+                    'avgMs': round(total / count * 1000, 3),
+                    'maxMs': round(longest * 1000, 3),
+                    'totalMs': round(total * 1000, 1),
+                }
+                for section, (count, total, longest) in sorted(self.timings.items(), key=lambda item: -item[1][1])
+            },
+            'profiling': self.profiling,
+        }
+
+diagnostics = Diagnostics()
+
+# Message dispatch: message type -> (handler, compiled validator).
+# Handlers are coroutines taking (websocket, client_id, data); rooms and plugins
+# can add their own through register_handler.
+MESSAGE_HANDLERS: Dict[str, Any] = {}
+
+# Size limits, checked before anything is decoded
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", 8192))
+MAX_ID_LENGTH = 64
+MAX_NAME_LENGTH = 64
+MAX_ADDRESS_LENGTH = 42
+MAX_CHAT_LENGTH = 500
+MAX_PROMPT_LENGTH = 1000
+
+def text(max_length: int, min_length: int = 1):
+    """Schema check for a string of bounded length, non-empty by default"""
+    return lambda value: isinstance(value, str) and min_length <= len(value) <= max_length
+
+def compile_schema(schema: Dict[str, Any]):
+    """Compile a schema into a validator returning an error string, or None when valid.
+
+    Each field maps to a type (isinstance check), a nested schema dict, or a
+    predicate such as text(). Every listed field is required; extra fields are allowed.
+    """
+    checks = []
+    for field, spec in schema.items():
+        if isinstance(spec, dict):
+            nested = compile_schema(spec)
+            def check(data, field=field, nested=nested):
+                value = data.get(field)
+                if not isinstance(value, dict):
+                    return f"'{field}' must be an object"
+                error = nested(value)
+                return f"{field}.{error}" if error else None
+        elif isinstance(spec, (type, tuple)):
+            def check(data, field=field, spec=spec):
+                return None if isinstance(data.get(field), spec) else f"'{field}' is missing or has the wrong type"
+        else:
+            def check(data, field=field, spec=spec):
+                return None if spec(data.get(field)) else f"'{field}' is missing or invalid"
+        checks.append(check)
     
-    # Generate a random client ID
-    client_id = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8))
+    def validate(data):
+        for check in checks:
+            error = check(data)
+            if error:
+                return error
+        return None
+    return validate
+
+def register_handler(message_type: str, schema: Dict[str, Any] = None):
+    """Decorator registering a handler (and its schema) for a message type"""
+    validator = compile_schema(schema or {})
+    def decorator(handler):
+        MESSAGE_HANDLERS[message_type] = (handler, validator)
+        return handler
+    return decorator
+
+async def dispatch_message(websocket, client_id: str, message: Union[str, bytes]):
+    """Decode, validate and route one inbound frame"""
+    size = len(message.encode('utf-8')) if isinstance(message, str) else len(message)
+    if size > MAX_MESSAGE_BYTES:
+        print(f"Rejected {size} byte frame from client {client_id}")
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'Message too large.'
+        })
+        return
     
     try:
-        # Add client to set of connected clients
-        clients.add(websocket)
-        print(f"Client {client_id} connected. Total clients: {len(clients)}")
-        
-        # Send initial state immediately on connection
-        await websocket.send(json.dumps({
-            'type': 'gameState',
-            'data': get_client_game_state()
-        }))
-        
-        print(f"Sent initial game state to client {client_id} with {len(game_state['players'])} players")
-        
-        # Handle incoming messages
-        async for message in websocket:
-            try:
-                data = json.loads(message)
-                print(f"Received from client {client_id}: {data.get('type')}")
-                
-                # Handle join game
-                if data.get('type') == 'joinGame' and data.get('player'):
-                    print(f"Player joining: {data['player']['name']} (ID: {data['player']['id']})")
-                    
-                    # Add player to game state if not already present
-                    player_exists = any(p['id'] == data['player']['id'] for p in game_state['players'])
-                    if not player_exists:
-                        game_state['players'].append(data['player'])
-                        print(f"Added player to game state. Total players: {len(game_state['players'])}")
-                        print(f"Current players: {', '.join(p['name'] for p in game_state['players'])}")
-                    else:
-                        print(f"Player {data['player']['name']} already exists in game state.")
-                    
-                    # Send confirmation back to the player
-                    await websocket.send(json.dumps({
-                        'type': 'joinConfirmed',
-                        'player': data['player']
-                    }))
-                    
-                    # Broadcast updated player list
-                    print(f"Broadcasting player update to {len(clients)} clients")
-                    await broadcast({
-                        'type': 'playersUpdate',
-                        'players': [scrub_player_data(p) for p in game_state['players']]
-                    })
-                    
-                    print_game_state()
-                
-                # Handle player leaving
-                elif data.get('type') == 'playerLeft' and data.get('playerId'):
-                    print(f"Player leaving: {data['playerId']}")
-                    
-                    # Remove player from game state
-                    player_index = next((i for i, p in enumerate(game_state['players']) if p['id'] == data['playerId']), -1)
-                    if player_index != -1:
-                        removed_player = game_state['players'].pop(player_index)
-                        print(f"Removed player: {removed_player['name']}")
-                        
-                        # Broadcast updated player list
-                        await broadcast({
-                            'type': 'playersUpdate',
-                            'players': [scrub_player_data(p) for p in game_state['players']]
-                        })
-                        
-                        print_game_state()
-                    else:
-                        print(f"Player {data['playerId']} not found in game state.")
-                
-                # Handle chat messages
-                elif data.get('type') == 'chatMessage' and data.get('message'):
-                    print(f"Chat message from {data['message']['senderName']}: {data['message']['text']}")
-                    
-                    # Check if sender is the AI-controlled player
-                    if game_state['gameInProgress'] and data['message']['senderId'] == game_state['aiPlayer']:
-                        # Reject message from AI-controlled player
-                        await websocket.send(json.dumps({
-                            'type': 'errorMessage',
-                            'message': 'You are the AI-controlled player for this game and cannot send messages.'
-                        }))
-                        continue
-                    
-                    # Store message in game state
-                    game_state['messages'].append(data['message'])
-                    
-                    # Broadcast message to all clients
-                    await broadcast({
-                        'type': 'newMessage',
-                        'message': data['message']
-                    })
-                    
-                    # If game is in progress and we have an AI player, maybe generate a response
-                    if (game_state['gameInProgress'] and 
-                        game_state['aiPlayer'] and 
-                        len(game_state['promptLibrary']) > 0 and
-                        random.random() < 0.3):  # 30% chance of responding
-                        
-                        ai_player = next((p for p in game_state['players'] if p['id'] == game_state['aiPlayer']), None)
-                        if ai_player:
-                            # Slight delay to make it seem like typing
-                            await asyncio.sleep(random.uniform(1.0, 2.5))
-                            await generate_and_send_ai_message()
-                
-                # Handle prompt submission
-                elif data.get('type') == 'submitPrompt' and data.get('prompt'):
-                    print(f"Prompt submitted: {data['prompt']}")
-                    
-                    if not any(p == data['prompt'] for p in game_state['promptLibrary']):
-                        game_state['promptLibrary'].append(data['prompt'])
-                    
-                    await websocket.send(json.dumps({
-                        'type': 'promptConfirmed',
-                        'prompt': data['prompt']
-                    }))
-                    
-                    print(f"Prompt library now has {len(game_state['promptLibrary'])} prompts")
-                
-                # Handle create game
-                elif data.get('type') == 'createGame':
-                    print(f"Create game request from client {client_id}")
-                    
-                    if game_state['gameInProgress']:
-                        await websocket.send(json.dumps({
-                            'type': 'errorMessage',
-                            'message': 'A game is already in progress.'
-                        }))
-                    else:
-                        # Reset game state
-                        game_state['messages'] = []
-                        game_state['votes'] = {}
-                        game_state['gameResults'] = None
-                        
-                        # Start 30 second countdown
-                        game_state['nextGameTime'] = int(time.time() * 1000) + 30000
-                        game_state['currentGameId'] = str(int(game_state['currentGameId']))
-                        
-                        # Broadcast game creation
-                        await broadcast({
-                            'type': 'gameState',
-                            'data': get_client_game_state()
-                        })
-                        
-                        print("New game created")
-                        print_game_state()
-                
-                # Handle voting
-                elif data.get('type') == 'vote' and data.get('voterId') and data.get('votedForId'):
-                    if not game_state['votingOpen']:
-                        await websocket.send(json.dumps({
-                            'type': 'errorMessage',
-                            'message': 'Voting is not currently open.'
-                        }))
-                        continue
-                    
-                    # Check if voter is the AI player
-                    if data['voterId'] == game_state['aiPlayer']:
-                        await websocket.send(json.dumps({
-                            'type': 'errorMessage',
-                            'message': 'As the AI-controlled player, you cannot vote.'
-                        }))
-                        continue
-                    
-                    # Record vote
-                    game_state['votes'][data['voterId']] = data['votedForId']
-                    
-                    await websocket.send(json.dumps({
-                        'type': 'voteConfirmed',
-                        'votedForId': data['votedForId']
-                    }))
-                    
-                    # Check if all eligible players have voted
-                    eligible_voters = [p['id'] for p in game_state['players'] if p['id'] != game_state['aiPlayer']]
-                    if all(voter in game_state['votes'] for voter in eligible_voters):
-                        # End voting early if everyone has voted
-                        asyncio.create_task(end_voting())
-                
-                # Handle ping messages
-                elif data.get('type') == 'ping':
-                    await websocket.send(json.dumps({
-                        'type': 'pong',
-                        'timestamp': int(time.time() * 1000)
-                    }))
-                
-                # Handle get state messages
-                elif data.get('type') == 'getState':
-                    await websocket.send(json.dumps({
-                        'type': 'gameState',
-                        'data': get_client_game_state()
-                    }))
-                
-                # Handle reset messages
-                elif data.get('type') == 'reset':
-                    game_state['players'] = []
-                    game_state['messages'] = []
-                    game_state['nextGameTime'] = int(time.time() * 1000) + 30000
-                    game_state['gameInProgress'] = False
-                    game_state['votingOpen'] = False
-                    game_state['aiPlayer'] = None
-                    game_state['votes'] = {}
-                    game_state['gameResults'] = None
-                    
-                    await broadcast({
-                        'type': 'gameState',
-                        'data': get_client_game_state()
-                    })
-                    
-                    print("Game state has been reset")
-                    print_game_state()
-                
-            except Exception as error:
-                print(f"Error processing message: {error}")
+        data = decode_frame(message, websocket.subprotocol)
+    except Exception as error:
+        print(f"Dropping malformed frame from client {client_id}: {error}")
+        return
+    if not isinstance(data, dict) or not isinstance(data.get('type'), str):
+        print(f"Dropping frame without a message type from client {client_id}")
+        return
+    print(f"Received from client {client_id}: {data.get('type')}")
+    record_inbound(client_id, data)
     
-    except Exception as e:
-        print(f"Connection error: {e}")
+    entry = MESSAGE_HANDLERS.get(data.get('type'))
+    if entry is None:
+        print(f"Ignoring unknown message type from client {client_id}: {data.get('type')}")
+        return
+    handler, validator = entry
+    
+    # Drop messages over their per-type limit
+    if not allow_message(websocket, data):
+        print(f"Throttled {data.get('type')} from client {client_id}")
+        await send_throttled_notice(websocket, data.get('type'))
+        return
     
+    error = validator(data)
+    if error:
+        print(f"Invalid {data['type']} from client {client_id}: {error}")
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': f"Invalid {data['type']} message."
+        })
+        return
+    
+    started = time.perf_counter()
+    try:
+        await handler(websocket, client_id, data)
     finally:
-        # Handle client disconnection
-        print(f"Client {client_id} disconnected")
-        clients.discard(websocket)
-        print(f"Total clients: {len(clients)}")
+        diagnostics.record(f"handler.{data['type']}", time.perf_counter() - started)
 
-def scrub_player_data(player):
-    """Remove sensitive data from player objects before sending to clients"""
-    # Create a copy to avoid modifying the original
-    player_copy = player.copy()
+# Players can join before connecting a wallet, so the address may be empty
+@register_handler('joinGame', {'player': {
+    'id': text(MAX_ID_LENGTH),
+    'name': text(MAX_NAME_LENGTH),
+    'walletAddress': text(MAX_ADDRESS_LENGTH, min_length=0),
+}})
+async def handle_join_game(websocket, client_id, data):
+    """Handle join game"""
+    player = data['player']
+    print(f"Player joining: {player['name']} (ID: {player['id']})")
     
-    # Add an isAI field that's only true for the client if they are the AI player
-    player_copy['isAI'] = player['id'] == game_state['aiPlayer']
+    # Track liveness for this player through this socket. It gets its room's
+    # updates as a player from now on, not through the spectator feed.
+    if not bind_player(websocket, player['id']):
+        print(f"Refused join as {player['id']} from client {client_id}, that player is connected elsewhere")
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'That player is already connected.'
+        })
+        return
+    unspectate(websocket)
+    
+    room = room_of(player['id'])
+    if draining and not room['gameInProgress']:
+        # New games start on the next process
+        await send_reconnect_hint(websocket)
+        return
+    if room is not game_state:
+        # Reconnecting to their game, still running or showing its results.
+        # Only createGame moves them on to the next one.
+        print(f"Player {player['name']} rejoined game {room['roomId']}")
+        if room['votingOpen'] and room['voteTally'] and player['id'] != room['aiPlayer']:
+            room['voteTally'].add_voter(player['id'], player['name'])
+        await send_message(websocket, {
+            'type': 'joinConfirmed',
+            'player': player
+        })
+        await send_message(websocket, {
+            'type': 'gameState',
+            'data': get_client_game_state(room)
+        })
+        return
+    
+    enqueue_player(player)
+    print(f"Queued {player['name']} for matchmaking. Players waiting: {len(matchmaking_queue)}")
+    
+    # Send confirmation back to the player
+    await send_message(websocket, {
+        'type': 'joinConfirmed',
+        'player': player
+    })
+    
+    # Broadcast updated lobby
+    await broadcast({
+        'type': 'gameState',
+        'data': get_client_game_state(game_state)
+    }, game_state)
+    
+    # Start a game straight away if the queue is full
+    await run_matchmaking()
+    
+    print_game_state()
+
+@register_handler('playerLeft', {'playerId': text(MAX_ID_LENGTH)})
+async def handle_player_left(websocket, client_id, data):
+    """Handle player leaving"""
+    print(f"Player leaving: {data['playerId']}")
+    
+    # Remove player from their room (or the lobby)
+    room = room_of(data['playerId'])
+    removed_player = remove_player(data['playerId'])
+    if removed_player:
+        print(f"Removed player: {removed_player['name']}")
+        
+        if room is game_state:
+            update_lobby_countdown()
+        
+        # Broadcast updated player list
+        await broadcast({
+            'type': 'playersUpdate',
+            'players': [scrub_player_data(p, room) for p in room['players']]
+        }, room)
+        
+        check_voting_complete(room)
+        
+        print_game_state(room)
+    else:
+        print(f"Player {data['playerId']} not found in game state.")
+
+@register_handler('chatMessage', {'message': {
+    'id': text(MAX_ID_LENGTH),
+    'senderId': text(MAX_ID_LENGTH),
+    'senderName': text(MAX_NAME_LENGTH),
+    'text': text(MAX_CHAT_LENGTH),
+    'timestamp': (int, float),
+}})
+async def handle_chat_message(websocket, client_id, data):
+    """Handle chat messages"""
+    print(f"Chat message from {data['message']['senderName']}: {data['message']['text']}")
+    
+    room = room_of(data['message']['senderId'])
+    
+    # Check if sender is the AI-controlled player
+    if room['gameInProgress'] and data['message']['senderId'] == room['aiPlayer']:
+        # Reject message from AI-controlled player
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'You are the AI-controlled player for this game and cannot send messages.'
+        })
+        return
+    
+    # Store message in the sender's room
+    room['messages'].append(data['message'])
+    
+    # Broadcast message to everyone in the room
+    await broadcast({
+        'type': 'newMessage',
+        'message': data['message']
+    }, room)
+    
+    # If game is in progress and we have an AI player, maybe generate a response
+    if (room['gameInProgress'] and 
+        room['aiPlayer'] and 
+        len(prompt_library) > 0 and
+        rng.random() < 0.3):  # 30% chance of responding
+        
+        # Slight delay to make it seem like typing
+        ai_scheduler.request(room, delay=rng.uniform(1.0, 2.5))
+
+@register_handler('submitPrompt', {'prompt': text(MAX_PROMPT_LENGTH)})
+async def handle_submit_prompt(websocket, client_id, data):
+    """Handle prompt submission"""
+    print(f"Prompt submitted: {data['prompt']}")
+    
+    prompt_library.add(data['prompt'])
+    
+    await send_message(websocket, {
+        'type': 'promptConfirmed',
+        'prompt': data['prompt']
+    })
+    
+    print(f"Prompt library now has {len(prompt_library)} prompts")
+
+@register_handler('createGame')
+async def handle_create_game(websocket, client_id, data):
+    """Handle create game. Games are formed by matchmaking, so this puts the client's players back in the queue."""
+    print(f"Create game request from client {client_id}")
+    
+    room = room_for_connection(websocket)
+    if room['gameInProgress']:
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'A game is already in progress.'
+        })
+        return
+    
+    if draining:
+        await send_reconnect_hint(websocket)
+        return
+    
+    # Players coming from a finished game go back to the queue
+    if room is not game_state:
+        for player_id in list(connection_players.get(websocket, ())):
+            if player_rooms.get(player_id) is room:
+                await requeue_player(player_id)
+    
+    await broadcast({
+        'type': 'gameState',
+        'data': get_client_game_state(game_state)
+    }, game_state)
+    
+    await run_matchmaking()
+    
+    print_game_state()
+
+@register_handler('vote', {'voterId': text(MAX_ID_LENGTH), 'votedForId': text(MAX_ID_LENGTH)})
+async def handle_vote(websocket, client_id, data):
+    """Handle voting"""
+    room = room_of(data['voterId'])
+    if not room['votingOpen']:
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'Voting is not currently open.'
+        })
+        return
+    
+    # Check if voter is the AI player
+    if data['voterId'] == room['aiPlayer']:
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'As the AI-controlled player, you cannot vote.'
+        })
+        return
+    
+    # Record vote
+    room['voteTally'].cast(data['voterId'], data['votedForId'])
+    
+    await send_message(websocket, {
+        'type': 'voteConfirmed',
+        'votedForId': data['votedForId']
+    })
+    
+    # End voting early if everyone has voted
+    check_voting_complete(room)
+
+@register_handler('ping')
+async def handle_ping(websocket, client_id, data):
+    """Handle ping messages"""
+    await send_message(websocket, {
+        'type': 'pong',
+        'timestamp': int(clock.time() * 1000)
+    })
+
+@register_handler('getState')
+async def handle_get_state(websocket, client_id, data):
+    """Handle get state messages"""
+    await send_message(websocket, {
+        'type': 'gameState',
+        'data': get_client_game_state(room_for_connection(websocket))
+    })
+
+@register_handler('spectate', {'roomId': text(MAX_ID_LENGTH)})
+async def handle_spectate(websocket, client_id, data):
+    """Handle a request to watch a game room (or the lobby)"""
+    room = game_state if data['roomId'] == game_state['roomId'] else rooms.get(data['roomId'])
+    if room is None:
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'That game does not exist.'
+        })
+        return
+    
+    spectate(websocket, room)
+    print(f"Client {client_id} is spectating {room['roomId']}. Spectators: {len(room_spectators.get(room['roomId'], ()))}")
+    
+    await send_message(websocket, {
+        'type': 'gameState',
+        'data': get_client_game_state(room_for_connection(websocket))
+    })
+
+@register_handler('diagnostics', {'token': text(256), 'action': text(32)})
+async def handle_diagnostics(websocket, client_id, data):
+    """Handle admin diagnostics requests: 'stats', 'profileStart' or 'profileStop'"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(data['token'], ADMIN_TOKEN):
+        print(f"Rejected diagnostics request from client {client_id}")
+        await send_message(websocket, {
+            'type': 'errorMessage',
+            'message': 'Not authorized.'
+        })
+        return
+    
+    reply = {'type': 'diagnostics', 'data': diagnostics.snapshot()}
+    if data['action'] == 'profileStart':
+        reply['profiling'] = diagnostics.start_profile()
+    elif data['action'] == 'profileStop':
+        reply['profilePath'] = diagnostics.stop_profile()
+    
+    await send_message(websocket, reply)
+
+@register_handler('getStats')
+async def handle_get_stats(websocket, client_id, data):
+    """Handle stats requests: the leaderboard, plus a player's stats for walletAddress (or playerId for players without a wallet) and a persona's fool rate for persona (its prompt)"""
+    player_key = data.get('walletAddress') or data.get('playerId')
+    player_stats = None
+    if isinstance(player_key, str) and len(player_key) <= MAX_ID_LENGTH:
+        player_stats = game_archive.player_stats(player_key)
+    
+    persona = data.get('persona')
+    persona_stats = None
+    if isinstance(persona, str) and persona:
+        persona_stats = game_archive.persona_stats(persona)
+    
+    await send_message(websocket, {
+        'type': 'stats',
+        'data': {
+            'leaderboard': game_archive.leaderboard(),
+            'player': player_stats,
+            'persona': persona_stats
+        }
+    })
+
+@register_handler('reset')
+async def handle_reset(websocket, client_id, data):
+    """Handle reset messages"""
+    for room in list(rooms.values()):
+        close_room(room)
+    for player in game_state['players']:
+        unbind_player(player['id'])
+    matchmaking_queue.clear()
+    game_state['players'] = []
+    game_state['messages'] = []
+    game_state['nextGameTime'] = None
+    game_state['gameInProgress'] = False
+    game_state['votingOpen'] = False
+    game_state['aiPlayer'] = None
+    game_state['votes'] = {}
+    game_state['voteTally'] = None
+    game_state['gameResults'] = None
+    
+    await broadcast({
+        'type': 'gameState',
+        'data': get_client_game_state(game_state)
+    })
+    
+    print("Game state has been reset")
+    print_game_state()
+
+async def handle_connection(websocket: websockets.WebSocketServerProtocol, path: str):
+    """Handle a new WebSocket connection"""
+    
+    # Generate a random client ID
+    client_id = ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8))
+    
+    try:
+        # Add client to set of connected clients
+        clients.add(websocket)
+        touch_connection(websocket)
+        
+        # Until they join, new sockets watch the lobby as spectators
+        spectate(websocket, game_state)
+        print(f"Client {client_id} connected. Total clients: {len(clients)}")
+        
+        # Send initial state immediately on connection
+        await send_message(websocket, {
+            'type': 'gameState',
+            'data': get_client_game_state(game_state)
+        })
+        
+        print(f"Sent initial lobby state to client {client_id} with {len(game_state['players'])} players waiting")
+        
+        # Handle incoming messages
+        async for message in websocket:
+            # Any inbound frame counts as a sign of life
+            touch_connection(websocket)
+            
+            # Pause reading from sockets that exceed their frame budget
+            await apply_backpressure(websocket)
+            
+            try:
+                await dispatch_message(websocket, client_id, message)
+            except Exception as error:
+                print(f"Error processing message: {error}")
+    
+    except Exception as e:
+        print(f"Connection error: {e}")
+    
+    finally:
+        # Handle client disconnection
+        print(f"Client {client_id} disconnected")
+        clients.discard(websocket)
+        release_connection(websocket)
+        print(f"Total clients: {len(clients)}")
+
+def check_voting_complete(room):
+    """Signal start_voting to close the round once every eligible player has voted"""
+    tally = room['voteTally']
+    if room['votingOpen'] and tally and tally.complete() and room['votingClosed']:
+        room['votingClosed'].set()
+
+def scrub_player_data(player, room=None):
+    """Remove sensitive data from player objects before sending to clients"""
+    room = room or game_state
+    
+    # Create a copy to avoid modifying the original
+    player_copy = player.copy()
+    
+    # Add an isAI field that's only true for the client if they are the AI player
+    player_copy['isAI'] = player['id'] == room['aiPlayer']
     
     # Return the scrubbed player data
     return player_copy
 
-def get_client_game_state():
+def get_client_game_state(room=None):
     """Get game state data that's safe to send to clients"""
+    room = room or game_state
     client_state = {
-        'players': [scrub_player_data(p) for p in game_state['players']],
-        'gameInProgress': game_state['gameInProgress'],
-        'nextGameTime': game_state['nextGameTime'],
-        'currentGameId': game_state['currentGameId'],
-        'messages': game_state['messages'],
-        'votingOpen': game_state['votingOpen'],
-        'gameResults': game_state['gameResults']
+        'players': [scrub_player_data(p, room) for p in room['players']],
+        'gameInProgress': room['gameInProgress'],
+        'nextGameTime': room['nextGameTime'],
+        'currentGameId': room['currentGameId'],
+        'messages': room['messages'],
+        'votingOpen': room['votingOpen'],
+        'gameResults': room['gameResults']
     }
     return client_state
 
-async def generate_and_send_ai_message():
-    """Generate and send a message from the AI-controlled player"""
-    if not game_state['gameInProgress'] or not game_state['aiPlayer']:
-        return
+async def generate_ai_message(room):
+    """Generate the AI-controlled player's next message, or None if the game has moved on"""
+    if not room['gameInProgress'] or not room['aiPlayer']:
+        return None
         
     # Find AI player
-    ai_player = next((p for p in game_state['players'] if p['id'] == game_state['aiPlayer']), None)
+    ai_player = next((p for p in room['players'] if p['id'] == room['aiPlayer']), None)
     if not ai_player:
-        return
+        return None
         
-    # Choose a random prompt from the library
-    if not game_state['promptLibrary']:
-        prompt = "Be a normal, friendly person chatting with others."
-    else:
-        prompt = random.choice(game_state['promptLibrary'])
-        
-    global agentInit
-    # Generate AI message
-    if not agentInit:
-        initialize_agent(prompt, ai_player['name'])
-        agentInit = True
+    # Use the persona picked for this game
+    prompt = room['aiPrompt'] or DEFAULT_PROMPT
         
-    ai_message = await generate_ai_response(prompt, game_state['messages'], ai_player['name'])
+    # Generate AI message (the AgentKit path initializes the agent off the event loop)
+    started = time.perf_counter()
+    ai_message = await generate_ai_response(
+        prompt, room['messages'], ai_player['name'], ai_player['id'], f"Find the AI Game {room['currentGameId']}"
+    )
+    diagnostics.record('ai.generate', time.perf_counter() - started)
+    
+    # The game may have moved on while we were waiting for the model
+    if not room['gameInProgress'] or room['votingOpen'] or room_closed(room):
+        return None
+    return ai_message
+
+async def send_ai_message(room, ai_message: str):
+    """Post a message as the AI-controlled player"""
+    ai_player = next((p for p in room['players'] if p['id'] == room['aiPlayer']), None)
+    if not ai_player or not room['gameInProgress'] or room['votingOpen'] or room_closed(room):
+        return
     
     # Create message object
     message_obj = {
-        'id': ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
+        'id': ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
         'senderId': ai_player['id'],
         'senderName': ai_player['name'],
         'text': ai_message,
-        'timestamp': int(time.time() * 1000)
+        'timestamp': int(clock.time() * 1000)
     }
     
     # Store message in game state
-    game_state['messages'].append(message_obj)
+    room['messages'].append(message_obj)
+    room['aiLastSpokeAt'] = clock.time()
     
     # Broadcast message to all clients
     await broadcast({
         'type': 'newMessage',
         'message': message_obj
-    })
+    }, room)
     
     print(f"AI ({ai_player['name']}) said: {ai_message}")
 
+# AI turn scheduling. Every AI turn goes through one queue ordered by when the
+# room's phase ends and how long its AI has been quiet, so a game about to
+# vote is served before a chatty one and no room hogs the model. Requests and
+# tokens per minute are budgeted; a turn that can't be generated before its
+# phase ends is answered from cached replies instead.
+AI_REQUESTS_PER_MINUTE = float(os.environ.get("AI_REQUESTS_PER_MINUTE", 60))
+AI_TOKENS_PER_MINUTE = float(os.environ.get("AI_TOKENS_PER_MINUTE", 40000))
+AI_MAX_CONCURRENT = int(os.environ.get("AI_MAX_CONCURRENT", 4))          # Model calls in flight at once
+AI_REPLY_TOKENS = 100        # max_tokens of a reply
+AI_CONTEXT_MESSAGES = 10     # Chat messages sent along with each request
+AI_SILENCE_WEIGHT = 1.0      # Seconds of deadline one second of AI silence is worth
+AI_DEADLINE_MARGIN = 2.0     # Don't start a model call with less than latency + this left in the phase
+AI_REPLY_CACHE_SIZE = 20     # Generated replies kept per persona for load shedding
+
+def ai_wants_turn(room: Dict[str, Any]) -> bool:
+    return bool(room['gameInProgress'] and not room['votingOpen'] and room['aiPlayer'] and not room_closed(room))
+
+def estimate_ai_tokens(room: Dict[str, Any]) -> float:
+    # Roughly four characters per token, plus the persona's system prompt and the reply
+    context = sum(len(m['text']) for m in room['messages'][-AI_CONTEXT_MESSAGES:])
+    persona = len(render_system_prompt('', room['aiPrompt'] or DEFAULT_PROMPT))
+    return (context + persona) / 4 + AI_REPLY_TOKENS
+
+def new_ai_scheduler() -> AIScheduler:
+    """An AIScheduler for the current clock and rng"""
+    return AIScheduler(
+        clock, rng, generate_ai_message, send_ai_message, ai_wants_turn, estimate_ai_tokens, get_fallback_ai_message,
+        requests_per_minute=AI_REQUESTS_PER_MINUTE, tokens_per_minute=AI_TOKENS_PER_MINUTE,
+        max_concurrent=AI_MAX_CONCURRENT, silence_weight=AI_SILENCE_WEIGHT, deadline_margin=AI_DEADLINE_MARGIN,
+        reply_cache_size=AI_REPLY_CACHE_SIZE, record=diagnostics.record,
+    )
+
+ai_scheduler = new_ai_scheduler()
+
+# On-chain settlement. Results are submitted to BotOrNotGame.endGame from a
+# background worker so the game loop never waits on the chain. Disabled unless
+# SETTLEMENT_RPC_URL, SETTLEMENT_CONTRACT_ADDRESS and SETTLEMENT_PRIVATE_KEY are set.
+SETTLEMENT_RPC_URL = os.environ.get("SETTLEMENT_RPC_URL", "")  # e.g. http://127.0.0.1:8545 for anvil
+SETTLEMENT_CONTRACT_ADDRESS = os.environ.get("SETTLEMENT_CONTRACT_ADDRESS", "")
+SETTLEMENT_PRIVATE_KEY = os.environ.get("SETTLEMENT_PRIVATE_KEY", "")
+SETTLEMENT_QUEUE_PATH = os.environ.get(
+    "SETTLEMENT_QUEUE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settlement_queue.json")
+)
+SETTLEMENT_BATCH_SIZE = int(os.environ.get("SETTLEMENT_BATCH_SIZE", 10))            # Transactions sent per cycle
+SETTLEMENT_MAX_ATTEMPTS = int(os.environ.get("SETTLEMENT_MAX_ATTEMPTS", 8))
+SETTLEMENT_POLL_INTERVAL = float(os.environ.get("SETTLEMENT_POLL_INTERVAL", 2))     # Seconds between receipt checks
+SETTLEMENT_RECEIPT_TIMEOUT = float(os.environ.get("SETTLEMENT_RECEIPT_TIMEOUT", 120))  # Resend with a higher fee after this
+
+settlement_queue = SettlementQueue(
+    SETTLEMENT_QUEUE_PATH, SETTLEMENT_RPC_URL, SETTLEMENT_CONTRACT_ADDRESS, SETTLEMENT_PRIVATE_KEY,
+    batch_size=SETTLEMENT_BATCH_SIZE, max_attempts=SETTLEMENT_MAX_ATTEMPTS,
+    poll_interval=SETTLEMENT_POLL_INTERVAL, receipt_timeout=SETTLEMENT_RECEIPT_TIMEOUT,
+)
+
+# Game archive and player statistics. Finished games are appended to a JSON
+# lines archive; aggregates are updated as each game is archived and
+# snapshotted to disk, so lookups never scan history.
+GAME_ARCHIVE_PATH = os.environ.get("GAME_ARCHIVE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_archive.jsonl"))
+PLAYER_STATS_PATH = os.environ.get("PLAYER_STATS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "player_stats.json"))
+PLAYER_STATS_SAVE_DELAY = 5.0  # Seconds to batch stats updates before writing the snapshot
+LEADERBOARD_SIZE = 10
+
+class GameArchive:
+    """Append-only archive of finished games with incrementally maintained stats.
+
+    The archive file is the source of truth. The stats snapshot records how
+    far into the archive it has counted, so loading it only replays games
+    archived since (for example by a process we took over from). Wins are
+    bucketed by count like VoteTally, so the leaderboard is read from the
+    top down without sorting. Player stats are keyed by wallet address, since
+    clients make up a new player id on every join; players without a wallet
+    fall back to their player id.
+    """
+
+    SNAPSHOT_VERSION = 2  # Snapshots from other versions are rebuilt from the archive
+
+    def __init__(self, archive_path: str = None, stats_path: str = None):
+        self.archive_path = archive_path
+        self.stats_path = stats_path
+        self.writer = os.urandom(8).hex()                     # Tags our own archive lines, which are counted as they're written
+        self.loaded = False
+        self.offset = 0                                       # Bytes of the archive counted so far
+        self.players: Dict[str, Dict[str, int]] = {}          # wallet address (or player id) -> counters
+        self.personas: Dict[str, Dict[str, Any]] = {}         # prompt digest -> prompt and counters
+        self.wallet_wins: Dict[str, int] = {}                 # wallet address -> games won
+        self.by_wins: Dict[int, Dict[str, None]] = {}         # wins -> wallet addresses
+        self.max_wins = 0
+        self.save_handle = None
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.stats_path:
+            try:
+                with open(self.stats_path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') != self.SNAPSHOT_VERSION:
+                    raise ValueError(f"snapshot version {snapshot.get('version')}")
+                self.offset = snapshot['offset']
+                self.players = snapshot['players']
+                self.personas = snapshot['personas']
+                for address, wins in snapshot['walletWins'].items():
+                    self._set_wins(address, wins)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not load player stats from {self.stats_path}, rebuilding from the archive: {e}")
+                self.__init__(self.archive_path, self.stats_path)
+                self.loaded = True
+        self.catch_up()
+
+    def catch_up(self):
+        """Count games other processes appended to the archive since we last looked"""
+        if not self.archive_path or not self.loaded:
+            return
+        counted = 0
+        try:
+            with open(self.archive_path, 'rb') as f:
+                f.seek(self.offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Still being written
+                    self.offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Left behind by a writer that died mid-line
+                        print(f"Skipping corrupt line in {self.archive_path} at byte {self.offset - len(line)}")
+                        continue
+                    if record.get('writer') != self.writer:
+                        self._count(record)
+                        counted += 1
+        except FileNotFoundError:
+            return
+        if counted:
+            print(f"Counted {counted} archived games from {self.archive_path}")
+            self._schedule_save()
+
+    def archive(self, room: Dict[str, Any]) -> Dict[str, Any]:
+        """Archive a finished game and update the stats. Call before the room's game state is released."""
+        self._ensure_loaded()
+        results = room['gameResults']
+        record = {
+            'writer': self.writer,
+            'gameId': room['currentGameId'],
+            'endedAt': int(clock.time() * 1000),
+            'players': [[p['id'], p.get('name'), p.get('walletAddress')] for p in room['players']],
+            'aiPlayerId': results['aiPlayerId'],
+            'persona': room['aiPrompt'],
+            'votes': dict(room['voteTally'].ballots) if room['voteTally'] else {},
+            'mostVotedPlayerId': results['mostVotedPlayerId'],
+            'correctIdentification': results['correctIdentification'],
+            # Chat messages are client-supplied, don't trust their fields
+            'transcript': [
+                [m.get('senderId'), m.get('text'), m.get('timestamp')]
+                for m in room['messages'] if m.get('senderId') != 'system'
+            ],
+        }
+        
+        if self.archive_path:
+            try:
+                with open(self.archive_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            except OSError as e:
+                print(f"Could not archive game {record['gameId']} to {self.archive_path}: {e}")
+        
+        self._count(record)
+        self._schedule_save()
+        return record
+
+    def _count(self, record: Dict[str, Any]):
+        ai_id = record['aiPlayerId']
+        caught = record['correctIdentification']
+        keys = {player_id: address or player_id for player_id, _, address in record['players']}
+        
+        for player_id, key in keys.items():
+            stats = self.players.setdefault(key, {'games': 0, 'votes': 0, 'correctVotes': 0, 'aiGames': 0, 'aiUndetected': 0, 'wins': 0})
+            stats['games'] += 1
+            if player_id == ai_id:
+                stats['aiGames'] += 1
+                stats['aiUndetected'] += 0 if caught else 1
+        for voter_id, candidate_id in record['votes'].items():
+            stats = self.players.get(keys.get(voter_id))
+            if stats is not None:
+                stats['votes'] += 1
+                stats['correctVotes'] += 1 if candidate_id == ai_id else 0
+        
+        if record['persona']:
+            key = PromptLibrary.digest(record['persona']).hex()
+            persona = self.personas.setdefault(key, {'prompt': record['persona'], 'games': 0, 'fooled': 0})
+            persona['games'] += 1
+            persona['fooled'] += 0 if caught else 1
+        
+        # Same rule as BotOrNotGame.claimRewards: correct voters win if the AI
+        # was caught, otherwise the AI player does
+        if caught:
+            winners = {voter_id for voter_id, candidate_id in record['votes'].items() if candidate_id == ai_id and voter_id != ai_id}
+        else:
+            winners = {ai_id}
+        for player_id, _, address in record['players']:
+            if player_id in winners:
+                self.players[keys[player_id]]['wins'] += 1
+                if address:
+                    self._set_wins(address, self.wallet_wins.get(address, 0) + 1)
+
+    def last_game_id(self) -> int:
+        """Highest numeric game id in the archive, or 0. Reads the whole archive, only used to seed game ids."""
+        last = 0
+        if not self.archive_path:
+            return last
+        try:
+            with open(self.archive_path, 'rb') as f:
+                for line in f:
+                    try:
+                        last = max(last, int(json.loads(line)['gameId']))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            pass
+        return last
+
+    def _set_wins(self, address: str, wins: int):
+        old_wins = self.wallet_wins.get(address, 0)
+        if old_wins:
+            del self.by_wins[old_wins][address]
+            if not self.by_wins[old_wins]:
+                del self.by_wins[old_wins]
+        self.wallet_wins[address] = wins
+        self.by_wins.setdefault(wins, {})[address] = None
+        self.max_wins = max(self.max_wins, wins)
+
+    def player_stats(self, key: str):
+        """A player's counters and rates by wallet address (or player id if they have none), or None if they haven't finished a game"""
+        self._ensure_loaded()
+        stats = self.players.get(key)
+        if stats is None:
+            return None
+        return dict(
+            stats,
+            detectionRate=stats['correctVotes'] / stats['votes'] if stats['votes'] else None,
+            foolRate=stats['aiUndetected'] / stats['aiGames'] if stats['aiGames'] else None,
+        )
+
+    def persona_stats(self, prompt: str):
+        """How often the AI playing a persona went undetected, or None if it hasn't been played"""
+        self._ensure_loaded()
+        persona = self.personas.get(PromptLibrary.digest(prompt).hex())
+        if persona is None:
+            return None
+        return dict(persona, foolRate=persona['fooled'] / persona['games'])
+
+    def leaderboard(self, limit: int = LEADERBOARD_SIZE) -> List[Dict[str, Any]]:
+        """Wallets with the most wins, best first"""
+        self._ensure_loaded()
+        entries = []
+        wins = self.max_wins
+        while wins > 0 and len(entries) < limit:
+            for address in self.by_wins.get(wins, ()):
+                entries.append({'walletAddress': address, 'wins': wins})
+                if len(entries) == limit:
+                    break
+            wins -= 1
+        return entries
+
+    def _schedule_save(self):
+        if not self.stats_path or self.save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self.save_handle = loop.call_later(PLAYER_STATS_SAVE_DELAY, self.save)
+
+    def save(self):
+        """Snapshot the stats along with how much of the archive they cover"""
+        self.save_handle = None
+        if not self.stats_path:
+            return
+        # Everything up to the snapshot's offset must be counted
+        self.catch_up()
+        tmp_path = f"{self.stats_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'version': self.SNAPSHOT_VERSION,
+                    'offset': self.offset,
+                    'players': self.players,
+                    'personas': self.personas,
+                    'walletWins': self.wallet_wins,
+                }, f)
+            os.replace(tmp_path, self.stats_path)
+        except OSError as e:
+            print(f"Could not save player stats to {self.stats_path}: {e}")
+
+game_archive = GameArchive(GAME_ARCHIVE_PATH, PLAYER_STATS_PATH)
+
+# Game ids are counted in a file shared with any process we hand off to, so no
+# two games (in the archive, the stats or on-chain) ever get the same id. A
+# fresh counter carries on from the archive.
+GAME_ID_COUNTER_PATH = os.environ.get("GAME_ID_COUNTER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "game_id_counter"))
+game_ids = GameIdCounter(GAME_ID_COUNTER_PATH, seed=lambda: game_archive.last_game_id() + 1)
+
+# Matchmaking settings
+MATCH_MIN_PLAYERS = int(os.environ.get("MATCH_MIN_PLAYERS", 2))
+MATCH_MAX_PLAYERS = int(os.environ.get("MATCH_MAX_PLAYERS", 6))
+MATCH_MAX_WAIT = float(os.environ.get("MATCH_MAX_WAIT", 30))            # Seconds the oldest player waits before a smaller game starts
+ROOM_RESULTS_LINGER = float(os.environ.get("ROOM_RESULTS_LINGER", 120))  # Seconds a finished room stays open on its results
+
+# Lobby players waiting for a game, oldest first: player id -> time queued (epoch seconds)
+matchmaking_queue: "OrderedDict[str, float]" = OrderedDict()
+
+def enqueue_player(player: Dict[str, Any]):
+    """Put a player in the lobby and the matchmaking queue"""
+    if not any(p['id'] == player['id'] for p in game_state['players']):
+        game_state['players'].append(player)
+    if player['id'] not in matchmaking_queue:
+        matchmaking_queue[player['id']] = clock.time()
+    update_lobby_countdown()
+
+def update_lobby_countdown():
+    """Show lobby clients when the next game will start at the latest"""
+    if len(matchmaking_queue) >= MATCH_MIN_PLAYERS:
+        oldest_queued = next(iter(matchmaking_queue.values()))
+        game_state['nextGameTime'] = int((oldest_queued + MATCH_MAX_WAIT) * 1000)
+    else:
+        game_state['nextGameTime'] = None
+
+def form_room(player_ids: List[str]) -> Dict[str, Any]:
+    """Move queued players out of the lobby into a new game room"""
+    game_id = game_state['currentGameId']
+    game_state['currentGameId'] = game_ids.next()
+    
+    matched = set(player_ids)
+    players = [p for p in game_state['players'] if p['id'] in matched]
+    game_state['players'] = [p for p in game_state['players'] if p['id'] not in matched]
+    
+    room = new_room(game_id, players)
+    rooms[game_id] = room
+    for player_id in player_ids:
+        matchmaking_queue.pop(player_id, None)
+        player_rooms[player_id] = room
+    
+    print(f"Matched {len(players)} players into game {game_id}: {', '.join(p['name'] for p in players)}")
+    return room
+
+async def run_matchmaking():
+    """Start a game for every full batch in the queue, or a smaller one once the oldest player has waited long enough"""
+    if draining:
+        return
+    now = clock.time()
+    formed = []
+    while matchmaking_queue:
+        oldest_queued = next(iter(matchmaking_queue.values()))
+        if len(matchmaking_queue) >= MATCH_MAX_PLAYERS:
+            batch = list(matchmaking_queue)[:MATCH_MAX_PLAYERS]
+        elif len(matchmaking_queue) >= MATCH_MIN_PLAYERS and now - oldest_queued >= MATCH_MAX_WAIT:
+            batch = list(matchmaking_queue)
+        else:
+            break
+        formed.append(form_room(batch))
+    
+    if not formed:
+        return
+    
+    update_lobby_countdown()
+    await broadcast({
+        'type': 'gameState',
+        'data': get_client_game_state(game_state)
+    }, game_state)
+    
+    # Each game runs on its own timers
+    for room in formed:
+        asyncio.create_task(start_game(room))
+
+def close_room(room: Dict[str, Any]):
+    """Close a game room. Players still in it are unbound and go back to watching the lobby."""
+    rooms.pop(room['roomId'], None)
+    for player in room['players']:
+        if player_rooms.get(player['id']) is room:
+            del player_rooms[player['id']]
+            unbind_player(player['id'])
+    
+    # Its spectators go back to watching the lobby
+    for websocket in list(room_spectators.get(room['roomId'], ())):
+        spectate(websocket, game_state)
+        spectators_behind.add(websocket)
+    print(f"Closed game room {room['roomId']}. Active rooms: {len(rooms)}")
+
+async def requeue_player(player_id: str):
+    """Move a player from a finished room back to the matchmaking queue"""
+    room = player_rooms.pop(player_id)
+    player = next(p for p in room['players'] if p['id'] == player_id)
+    room['players'] = [p for p in room['players'] if p['id'] != player_id]
+    if not room['players']:
+        close_room(room)
+    enqueue_player(player)
+
+# Graceful restarts. On SIGTERM the server stops accepting connections and
+# starting games, hands the lobby and finished rooms to the next process
+# straight away, and lets running games finish for up to DRAIN_TIMEOUT before
+# handing those over too. Handoffs are JSON files in HANDOFF_DIR that the new
+# process picks up (with SO_REUSEPORT it can already be listening on the port).
+# Clients get a 'reconnect' hint with a jittered delay so they don't all
+# reconnect at once.
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 90))                # Seconds to let running games finish
+HANDOFF_DIR = os.environ.get("HANDOFF_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "handoff"))
+HANDOFF_POLL_INTERVAL = 0.5
+RECONNECT_HINT_MS = int(os.environ.get("RECONNECT_HINT_MS", 1000))
+RECONNECT_JITTER_MS = int(os.environ.get("RECONNECT_JITTER_MS", 4000))
+ROOM_HANDOFF_FIELDS = (
+    'roomId', 'players', 'gameInProgress', 'nextGameTime', 'currentGameId', 'messages', 'aiPlayer',
+    'aiPrompt', 'aiPlayerAddress', 'votingOpen', 'phaseEndsAt', 'aiLastSpokeAt', 'gameResults', 'closeAt',
+)
+draining = False
+handoff_sequence = 0
+
+def export_room(room: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON-safe copy of a room, including an open vote"""
+    exported = {field: room[field] for field in ROOM_HANDOFF_FIELDS}
+    tally = room['voteTally']
+    if room['votingOpen'] and tally:
+        exported['tally'] = {'eligible': list(tally.eligible), 'names': tally.names, 'ballots': tally.ballots}
+    return exported
+
+def import_room(exported: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuild a room exported by export_room"""
+    room = new_room(exported['roomId'], exported['players'])
+    room.update({field: exported[field] for field in ROOM_HANDOFF_FIELDS})
+    if exported.get('tally'):
+        tally = VoteTally(exported['tally']['eligible'], exported['tally']['names'])
+        for voter_id, candidate_id in exported['tally']['ballots'].items():
+            tally.cast(voter_id, candidate_id)
+        room['voteTally'] = tally
+        room['votes'] = tally.ballots
+        room['votingClosed'] = asyncio.Event()
+    return room
+
+def write_handoff(handoff: Dict[str, Any]):
+    """Atomically write one handoff file for the next process"""
+    global handoff_sequence
+    handoff_sequence += 1
+    os.makedirs(HANDOFF_DIR, exist_ok=True)
+    path = os.path.join(HANDOFF_DIR, f"handoff-{os.getpid()}-{handoff_sequence:04d}.json")
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(handoff, f)
+    os.replace(f"{path}.tmp", path)
+    print(f"Wrote handoff {path}")
+
+def load_handoff(handoff: Dict[str, Any]):
+    """Merge state handed off by a draining process into ours"""
+    lobby = handoff.get('lobby')
+    if lobby:
+        for player in lobby['players']:
+            if player['id'] not in player_rooms and not any(p['id'] == player['id'] for p in game_state['players']):
+                game_state['players'].append(player)
+        queued = dict(matchmaking_queue)
+        for player_id, queued_at in handoff.get('queue', []):
+            queued.setdefault(player_id, queued_at)
+        matchmaking_queue.clear()
+        matchmaking_queue.update(sorted(queued.items(), key=lambda item: item[1]))
+        update_lobby_countdown()
+    
+    deadline = clock.monotonic() + RECONNECT_GRACE
+    for exported in handoff.get('rooms', []):
+        # Game ids come from the shared counter, so a handed-off game can't clash with ours
+        room = import_room(exported)
+        rooms[room['roomId']] = room
+        for player in room['players']:
+            # A player who already rejoined our lobby belongs to their handed-off game
+            if player['id'] in matchmaking_queue or any(p['id'] == player['id'] for p in game_state['players']):
+                matchmaking_queue.pop(player['id'], None)
+                game_state['players'] = [p for p in game_state['players'] if p['id'] != player['id']]
+            player_rooms[player['id']] = room
+        if room['gameInProgress']:
+            asyncio.create_task(resume_game(room))
+        print(f"Took over game {room['roomId']} ({'in progress' if room['gameInProgress'] else 'finished'})")
+    
+    # Players get the usual grace period to reconnect to us
+    for player in game_state['players'] + [p for r in rooms.values() for p in r['players']]:
+        if not is_player_connected(player['id']):
+            reaper_wheel.schedule(player['id'], deadline)
+    
+    if handoff.get('settlement'):
+        settlement_queue.adopt(handoff['settlement'])
+    
+    # Count the games the other process archived
+    game_archive.catch_up()
+
+async def handoff_loop():
+    """Pick up state handed off by a draining process"""
+    while not draining:
+        try:
+            names = sorted(n for n in os.listdir(HANDOFF_DIR) if n.endswith('.json'))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = os.path.join(HANDOFF_DIR, name)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    handoff = json.load(f)
+                os.remove(path)
+            except (OSError, ValueError) as e:
+                print(f"Could not read handoff {path}: {e}")
+                continue
+            print(f"Loading handoff {name}")
+            load_handoff(handoff)
+        await asyncio.sleep(HANDOFF_POLL_INTERVAL)
+
+async def send_reconnect_hint(websocket):
+    """Tell a client to reconnect (to the next process) after a jittered delay, then close its socket"""
+    try:
+        await send_message(websocket, {
+            'type': 'reconnect',
+            'retryAfterMs': RECONNECT_HINT_MS + rng.randrange(RECONNECT_JITTER_MS + 1)
+        })
+        await websocket.close(1012, "Server restarting")
+    except (websockets.ConnectionClosed, Exception):
+        pass
+
+async def hand_off_rooms(handed_off: List[Dict[str, Any]], include_lobby: bool = False, settlement=None):
+    """Hand rooms (and optionally the lobby) to the next process and send their clients over"""
+    handoff: Dict[str, Any] = {'rooms': [export_room(room) for room in handed_off]}
+    if include_lobby:
+        handoff['lobby'] = export_room(game_state)
+        handoff['queue'] = list(matchmaking_queue.items())
+    if settlement:
+        handoff['settlement'] = settlement
+    write_handoff(handoff)
+    
+    sockets = set()
+    for room in handed_off:
+        sockets |= room_recipients(room) | spectator_recipients(room)
+        close_room(room)
+    if include_lobby:
+        sockets |= room_recipients(game_state) | spectator_recipients(game_state)
+        for player_id in list(matchmaking_queue):
+            unbind_player(player_id)
+        matchmaking_queue.clear()
+        game_state['players'] = []
+    
+    await asyncio.gather(*(send_reconnect_hint(websocket) for websocket in sockets))
+    print(f"Handed off {len(handed_off)} rooms{' and the lobby' if include_lobby else ''}, {len(sockets)} clients told to reconnect")
+
+async def drain(server, settlement_task):
+    """Stop taking new work, let running games finish, and hand everything else to the next process"""
+    global draining
+    draining = True
+    print(f"Draining: {len(rooms)} rooms, {len(matchmaking_queue)} players queued")
+    
+    # Stop accepting connections but keep the open ones
+    server.close(close_connections=False)
+    
+    # Nothing will start in the lobby or finished rooms here any more
+    await hand_off_rooms([r for r in rooms.values() if not r['gameInProgress']], include_lobby=True)
+    
+    # Hand games over as they finish
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while any(r['gameInProgress'] for r in rooms.values()) and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+        finished = [r for r in rooms.values() if not r['gameInProgress']]
+        if finished:
+            await hand_off_rooms(finished)
+    
+    # Whatever is still running goes over mid-game, with the settlement backlog
+    settlement = await settlement_queue.stop(settlement_task)
+    await hand_off_rooms(list(rooms.values()), settlement=settlement)
+    
+    if prompt_library.save_handle is not None:
+        prompt_library.save_handle.cancel()
+        prompt_library.save()
+    if game_archive.save_handle is not None:
+        game_archive.save_handle.cancel()
+        game_archive.save()
+    
+    print("Drain complete")
+
+async def resume_game(room: Dict[str, Any]):
+    """Continue a handed-off game from the phase it was in"""
+    remaining = max(0.0, (room['phaseEndsAt'] or clock.time()) - clock.time())
+    print(f"Resuming game {room['roomId']} in {'voting' if room['votingOpen'] else 'chat'}, {remaining:.0f}s left")
+    await broadcast({
+        'type': 'gameState',
+        'data': get_client_game_state(room)
+    }, room)
+    
+    if room['votingOpen']:
+        await close_voting_when_done(room, remaining)
+        return
+    
+    await clock.sleep(remaining)
+    if room_closed(room):
+        return
+    await start_voting(room)
+
 async def start_game_loop():
     """Main game loop for managing game state transitions"""
     while True:
-        await asyncio.sleep(1)
-        now = int(time.time() * 1000)
-        
-        # If countdown completed and game not started yet and there's a valid next game time
-        # Note: We now check if nextGameTime exists before trying to start a new game
-        if (not game_state['gameInProgress'] and 
-            game_state['nextGameTime'] is not None and 
-            now >= game_state['nextGameTime'] and 
-            len(game_state['players']) >= 2):
-            # Start new game
-            await start_game()
-        
-        # Periodic AI messages during game
-        if game_state['gameInProgress'] and game_state['aiPlayer'] and random.random() < 0.05:  # 5% chance per second
-            await generate_and_send_ai_message()
-
-async def start_game():
+        await clock.sleep(1)
+        now = clock.time()
+        
+        # Form and start games from the matchmaking queue
+        await run_matchmaking()
+        
+        for room in list(rooms.values()):
+            # Close finished rooms once their results have been up long enough
+            if not room['gameInProgress'] and (not room['players'] or (room['closeAt'] and now >= room['closeAt'])):
+                close_room(room)
+                continue
+            
+            # Periodic AI messages during game
+            if room['gameInProgress'] and room['aiPlayer'] and not room['votingOpen'] and rng.random() < 0.05:  # 5% chance per second
+                ai_scheduler.request(room)
+
+async def start_game(room):
     """Start a new game with the current players"""
-    print("Starting new game!")
-    game_state['gameInProgress'] = True
-    game_state['votingOpen'] = False
-    game_state['messages'] = []
-    game_state['votes'] = {}
+    print(f"Starting game {room['currentGameId']} with {len(room['players'])} players")
+    room['gameInProgress'] = True
+    room['votingOpen'] = False
+    room['messages'] = []
+    room['votes'] = {}
+    room['voteTally'] = None
+    room['aiLastSpokeAt'] = None
     
-    # Choose a random player to be controlled by AI
-    if game_state['players']:
-        aiPlayer = random.choice(game_state['players'])
-        game_state['aiPlayer'] = aiPlayer['id']
-        game_state['aiPlayerAddress'] = aiPlayer['walletAddress']
+    # Choose a random player to be controlled by AI, preferring players that are still connected
+    if room['players']:
+        connected_players = [p for p in room['players'] if is_player_connected(p['id'])]
+        aiPlayer = rng.choice(connected_players or room['players'])
+        room['aiPlayer'] = aiPlayer['id']
+        room['aiPlayerAddress'] = aiPlayer['walletAddress']
     else:
-        game_state['aiPlayer'] = None
+        room['aiPlayer'] = None
+    
+    print(f"Selected AI player: {room['aiPlayer']}")
     
-    print(f"Selected AI player: {game_state['aiPlayer']}")
+    # Pick the persona once for the whole game and warm its rendered prompt
+    room['aiPrompt'] = prompt_library.choice(rng) or DEFAULT_PROMPT
+    if room['aiPlayer']:
+        render_system_prompt(aiPlayer['name'], room['aiPrompt'])
+    print(f"AI persona for this game: {room['aiPrompt']}")
     
     # Broadcast game start
     await broadcast({
         'type': 'gameState',
-        'data': get_client_game_state()
-    })
+        'data': get_client_game_state(room)
+    }, room)
     
     # Add system message
     system_message = {
-        'id': ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
+        'id': ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
         'senderId': 'system',
         'senderName': 'System',
-        'text': f'Game #{game_state["currentGameId"]} has started! One player is being controlled by AI. Chat for 1 minute and try to identify who it is.',
-        'timestamp': int(time.time() * 1000)
+        'text': f'Game #{room["currentGameId"]} has started! One player is being controlled by AI. Chat for 1 minute and try to identify who it is.',
+        'timestamp': int(clock.time() * 1000)
     }
-    game_state['messages'].append(system_message)
+    room['messages'].append(system_message)
     
     await broadcast({
         'type': 'newMessage',
         'message': system_message
-    })
+    }, room)
     
-    # Have AI player send a first message
-    await asyncio.sleep(random.uniform(3.0, 8.0))  # Wait a bit before first message
-    await generate_and_send_ai_message()
+    # Have AI player send a first message, a bit after the start
+    first_message_delay = rng.uniform(3.0, 8.0)
     
-    # Schedule game end after 60 seconds
-    await asyncio.sleep(60)
+    # Schedule game end 60 seconds after that
+    room['phaseEndsAt'] = clock.time() + first_message_delay + 60
+    ai_scheduler.request(room, delay=first_message_delay)
+    await clock.sleep(first_message_delay + 60)
+    if room_closed(room):
+        return
     
     # Start voting phase
-    await start_voting()
+    await start_voting(room)
 
-async def start_voting():
+async def start_voting(room):
     """Start the voting phase"""
     print("Starting voting phase")
-    game_state['votingOpen'] = True
+    
+    # Eligible voters are fixed here; joins and departures adjust the tally as they happen
+    room['voteTally'] = VoteTally(
+        (p['id'] for p in room['players'] if p['id'] != room['aiPlayer']),
+        {p['id']: p['name'] for p in room['players']}
+    )
+    room['votes'] = room['voteTally'].ballots
+    room['votingClosed'] = asyncio.Event()
+    room['votingOpen'] = True
+    room['phaseEndsAt'] = clock.time() + 15
     
     # Add system message
     system_message = {
-        'id': ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
+        'id': ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
         'senderId': 'system',
         'senderName': 'System',
         'text': 'Time to vote! Select the player you think is being controlled by AI. You have 10 seconds to vote.',
-        'timestamp': int(time.time() * 1000)
+        'timestamp': int(clock.time() * 1000)
     }
-    game_state['messages'].append(system_message)
+    room['messages'].append(system_message)
     
     await broadcast({
         'type': 'gameState',
-        'data': get_client_game_state()
-    })
+        'data': get_client_game_state(room)
+    }, room)
     
     await broadcast({
         'type': 'newMessage',
         'message': system_message
-    })
+    }, room)
     
-    # Schedule end of voting
-    await asyncio.sleep(15)
-    await end_voting()
+    await close_voting_when_done(room, 15)
 
-async def end_voting():
+async def close_voting_when_done(room, timeout: float):
+    """Wait for the voting window, or until everyone has voted, then end voting.
+    This is the only place voting gets closed from, so end_voting runs exactly once per round."""
+    check_voting_complete(room)
+    try:
+        await clock.wait_for(room['votingClosed'].wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+    if room_closed(room):
+        return
+    await end_voting(room)
+
+async def end_voting(room):
     """End the voting phase and determine results"""
     # Skip if voting is already closed
-    if not game_state['votingOpen']:
+    if not room['votingOpen']:
         return
         
     print("Ending voting phase")
-    game_state['votingOpen'] = False
-    
-    # Count votes
-    vote_counts = {}
-    for voted_for_id in game_state['votes'].values():
-        vote_counts[voted_for_id] = vote_counts.get(voted_for_id, 0) + 1
+    room['votingOpen'] = False
     
-    # Find player with most votes
-    most_voted_player_id = None
-    most_votes = 0
-    
-    for player_id, count in vote_counts.items():
-        if count > most_votes:
-            most_votes = count
-            most_voted_player_id = player_id
+    # Counts and the leader are already tallied
+    tally = room['voteTally']
+    vote_counts = dict(tally.counts)
+    most_voted_player_id = tally.leader()
     
     # Determine if players correctly identified AI
-    correct_identification = most_voted_player_id == game_state['aiPlayer']
+    correct_identification = most_voted_player_id == room['aiPlayer']
     
     # Get AI player name
-    ai_player_name = next((p['name'] for p in game_state['players'] if p['id'] == game_state['aiPlayer']), "Unknown")
+    ai_player_name = tally.names.get(room['aiPlayer'], "Unknown")
     
     # Get most voted player name
-    most_voted_player_name = "No one" if most_voted_player_id is None else next(
-        (p['name'] for p in game_state['players'] if p['id'] == most_voted_player_id), "Unknown"
-    )
+    most_voted_player_name = "No one" if most_voted_player_id is None else tally.names.get(most_voted_player_id, "Unknown")
     
     # Create results object
-    game_state['gameResults'] = {
-        'aiPlayerId': game_state['aiPlayer'],
+    room['gameResults'] = {
+        'aiPlayerId': room['aiPlayer'],
         'aiPlayerName': ai_player_name,
-        'aiPlayerAddress': game_state['aiPlayerAddress'],
+        'aiPlayerAddress': room['aiPlayerAddress'],
         'mostVotedPlayerId': most_voted_player_id,
         'mostVotedPlayerName': most_voted_player_name,
         'voteCounts': vote_counts,
@@ -959,59 +2457,284 @@ async def end_voting():
     
     # Add system message with results
     result_message = {
-        'id': ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
+        'id': ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
         'senderId': 'system',
         'senderName': 'System',
         'text': f'Voting has ended! The AI-controlled player was {ai_player_name}. Most votes: {most_voted_player_name}. '
                 f'{"Players correctly identified the AI!" if correct_identification else "The AI fooled the players!"}',
-        'timestamp': int(time.time() * 1000)
+        'timestamp': int(clock.time() * 1000)
     }
-    game_state['messages'].append(result_message)
+    room['messages'].append(result_message)
+    
+    # Hand the result to the settlement worker, the chain is never waited on here
+    if settlement_queue.enabled():
+        settlement_queue.enqueue(room['currentGameId'], room['aiPlayerAddress'])
+    
+    # Archive the game, then drop the voting state. The transcript stays until
+    # the room closes because the results screen shows it. A failed archive
+    # must not keep the results from going out.
+    try:
+        game_archive.archive(room)
+    except Exception as e:
+        print(f"Could not archive game {room['currentGameId']}: {type(e).__name__}: {e}")
+    room['voteTally'] = None
+    room['votes'] = {}
+    room['votingClosed'] = None
     
     await broadcast({
         'type': 'gameState',
-        'data': get_client_game_state()
-    })
+        'data': get_client_game_state(room)
+    }, room)
     
     await broadcast({
         'type': 'newMessage',
         'message': result_message
-    })
+    }, room)
     
-    # End game but don't prepare for next round automatically
-    game_state['gameInProgress'] = False
-    game_state['aiPlayer'] = None
-    # Remove the countdown to next game
-    game_state['nextGameTime'] = None
+    # End game. Players see the results until the room is closed or they queue up again.
+    room['gameInProgress'] = False
+    room['aiPlayer'] = None
+    room['nextGameTime'] = None
+    room['closeAt'] = clock.time() + ROOM_RESULTS_LINGER
     print("Game ended, showing results")
-    print_game_state()
+    print_game_state(room)
     
     # Broadcast updated game state
     await broadcast({
         'type': 'gameState',
-        'data': get_client_game_state()
-    })
+        'data': get_client_game_state(room)
+    }, room)
+
+# Simulation mode. Runs whole games against simulated players on a virtual
+# clock with a seeded rng, so the same seed always plays out the same way.
+SIMULATION_EPOCH = 1_700_000_000.0  # Virtual wall-clock time a simulation starts at
+SIMULATION_CHAT_REPLY_CHANCE = 0.1   # Chance a simulated player answers someone else's message
+SIMULATION_PROMPTS = [
+    "a laid back surfer who loves tacos",
+    "a retired history teacher who corrects everyone's grammar",
+    "a teenager who only talks about video games",
+    "a nervous first-time player who apologises a lot",
+]
+
+async def simulated_ai_response(prompt, messages, ai_player_name, ai_player_id, thread_id=None):
+    """Stand-in for the model in simulations: canned lines after a simulated model latency"""
+    await clock.sleep(rng.uniform(0.5, 2.0))
+    return get_fallback_ai_message()
+
+class SimulatedClient:
+    """Stand-in socket for a simulated player (or a replayed client).
+
+    Frames sent to it are decoded like a browser would; with a player it
+    chats, votes and queues up again using the shared rng.
+    """
+    subprotocol = None
+    transport = None
+
+    def __init__(self, index: int, client_id: str, results: Dict[str, Any], player: Dict[str, Any] = None, games_wanted: int = 0):
+        self.index = index
+        self.client_id = client_id
+        self.results = results
+        self.player = player
+        self.games_wanted = games_wanted
+        self.chatted_in = None
+        self.voted_in = None
+
+    def __hash__(self):
+        # Stable ordering in sets of sockets, independent of memory addresses
+        return self.index
+
+    async def send(self, frame: Union[str, bytes]):
+        decoded = json.loads(frame)
+        for message in decoded if isinstance(decoded, list) else [decoded]:
+            self.on_message(message)
+
+    async def deliver(self, data: Dict[str, Any], delay: float = 0):
+        await clock.sleep(delay)
+        await dispatch_message(self, self.client_id, json.dumps(data))
+
+    def act_later(self, delay: float, data: Dict[str, Any]):
+        asyncio.create_task(self.deliver(data, delay))
+
+    def on_message(self, message: Dict[str, Any]):
+        state = message.get('data') if message.get('type') == 'gameState' else None
+        if state and state.get('gameResults') and not state.get('gameInProgress'):
+            self.results.setdefault(state['currentGameId'], state['gameResults'])
+        if self.player is None:
+            return
+        
+        if message.get('type') == 'newMessage':
+            sender = message['message'].get('senderId')
+            if sender not in ('system', self.player['id']) and rng.random() < SIMULATION_CHAT_REPLY_CHANCE:
+                self.act_later(rng.uniform(2.0, 10.0), self.chat())
+        
+        if not state:
+            return
+        game_id = state['currentGameId']
+        if state.get('gameInProgress') and not state.get('votingOpen') and self.chatted_in != game_id:
+            self.chatted_in = game_id
+            self.act_later(rng.uniform(1.0, 10.0), self.chat())
+        elif state.get('votingOpen') and self.voted_in != game_id:
+            self.voted_in = game_id
+            candidates = [p for p in state['players'] if p['id'] != self.player['id']]
+            if candidates:
+                self.act_later(rng.uniform(1.0, 8.0), {
+                    'type': 'vote',
+                    'voterId': self.player['id'],
+                    'votedForId': rng.choice(candidates)['id']
+                })
+        elif state.get('gameResults') and not state.get('gameInProgress') and len(self.results) < self.games_wanted:
+            self.act_later(rng.uniform(1.0, 5.0), {'type': 'createGame'})
+
+    def chat(self) -> Dict[str, Any]:
+        return {
+            'type': 'chatMessage',
+            'message': {
+                'id': ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8)),
+                'senderId': self.player['id'],
+                'senderName': self.player['name'],
+                'text': get_fallback_ai_message(),
+                'timestamp': int(clock.time() * 1000)
+            }
+        }
+
+async def run_simulation(games: int, players: int, seed: int, replay_path: str = None):
+    """Play games on virtual time and return a summary of what happened"""
+    global clock, rng, reaper_wheel, prompt_library, game_archive, game_ids, ai_scheduler, settlement_queue, generate_ai_response, SESSION_RECORD_PATH
+    clock = VirtualClock(SIMULATION_EPOCH)
+    rng = random.Random(seed)
+    reaper_wheel = TimerWheel(resolution=1.0, now=clock.monotonic())
+    generate_ai_response = simulated_ai_response
+    settlement_queue = SettlementQueue(None)  # Not configured, so never enabled
+    SESSION_RECORD_PATH = None
+    
+    # Fixed personas, nothing is read from or written to disk
+    prompt_library = PromptLibrary(None, PROMPT_LIBRARY_MAX)
+    for prompt in SIMULATION_PROMPTS:
+        prompt_library.add(prompt)
+    game_archive = GameArchive()
+    game_ids = GameIdCounter()  # Games are numbered from 1 on every run
+    game_state['currentGameId'] = game_ids.next()
+    
+    results: Dict[str, Any] = {}
+    wall_start = time.perf_counter()
+    ai_scheduler = new_ai_scheduler()
+    game_loop_task = asyncio.create_task(start_game_loop())
+    ai_task = asyncio.create_task(ai_scheduler.run())
+    
+    if replay_path:
+        # Re-send recorded traffic at its recorded offsets
+        with open(replay_path, 'r', encoding='utf-8') as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+        sockets: Dict[str, SimulatedClient] = {}
+        start = recorded[0]['t'] if recorded else 0
+        pending = [len(recorded)]
+        
+        async def replay(entry):
+            await sockets[entry['client']].deliver(entry['message'], entry['t'] - start)
+            pending[0] -= 1
+        
+        for entry in recorded:
+            if entry['client'] not in sockets:
+                sockets[entry['client']] = SimulatedClient(len(sockets), entry['client'], results)
+                clients.add(sockets[entry['client']])
+            asyncio.create_task(replay(entry))
+        await clock.run_until(lambda: pending[0] == 0 and not any(r['gameInProgress'] for r in rooms.values()))
+    else:
+        for i in range(players):
+            player = {'id': f"sim-{i}", 'name': f"Player {i}", 'walletAddress': f"0x{i:040x}"}
+            bot = SimulatedClient(i, f"sim{i}", results, player, games)
+            clients.add(bot)
+            bot.act_later(rng.uniform(0.0, 5.0), {'type': 'joinGame', 'player': player})
+        await clock.run_until(lambda: len(results) >= games)
+    
+    game_loop_task.cancel()
+    ai_task.cancel()
+    wall_seconds = time.perf_counter() - wall_start
+    virtual_seconds = clock.monotonic()
+    return {
+        'games': len(results),
+        'aiCaught': sum(1 for r in results.values() if r['correctIdentification']),
+        'virtualSeconds': virtual_seconds,
+        'wallSeconds': wall_seconds,
+        'speedup': virtual_seconds / wall_seconds if wall_seconds else float('inf'),
+        'aiTurns': dict(ai_scheduler.counts),
+        'leaderboard': game_archive.leaderboard(3),
+        # Same seed, same digest: a quick check that a run was reproduced exactly
+        'digest': hashlib.sha1(json.dumps(results, sort_keys=True).encode('utf-8')).hexdigest(),
+    }
 
 async def main():
     # Start WebSocket server
     # Get port from environment variable (Render sets this automatically)
     PORT = int(os.environ.get("PORT", 8765))
+    
+    # Reserve the first game's id before anyone can see the lobby
+    game_state['currentGameId'] = game_ids.next()
 
     # In your main() function:
     server = await websockets.serve(
         handle_connection, 
         host="0.0.0.0",  # Change from "localhost" to "0.0.0.0" to accept all connections
-        port=PORT
+        port=PORT,
+        ping_interval=None,  # Heartbeats are driven by heartbeat_loop()
+        max_size=INBOUND_MAX_FRAME_BYTES,
+        max_queue=INBOUND_MAX_QUEUE,
+        subprotocols=SUPPORTED_SUBPROTOCOLS,
+        compression=None,  # Configured through the explicit extension below
+        extensions=get_compression_extensions(),
+        reuse_port=hasattr(socket, 'SO_REUSEPORT')  # Lets a replacement process listen before this one drains
     )
     
+    # Take over games from a process we're replacing
+    handoff_task = asyncio.create_task(handoff_loop())
+    
     # Start game loop
     game_loop_task = asyncio.create_task(start_game_loop())
     
+    # Start liveness tracking
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
+    reaper_task = asyncio.create_task(reaper_loop())
+    
+    # Start submitting game results on-chain
+    settlement_task = asyncio.create_task(settlement_queue.run())
+    
+    # Start scheduling AI turns
+    ai_task = asyncio.create_task(ai_scheduler.run())
+    
+    # Start watching the event loop
+    if DIAGNOSTICS_ENABLED:
+        diagnostics.start()
+    
     print('WebSocket server running on port 8765')
     print_game_state()
     
-    # Wait for the server to close
+    # Drain on SIGTERM/SIGINT instead of dropping every game
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stop_requested.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Not supported on Windows, stop with Ctrl+C as before
+    
+    await stop_requested.wait()
+    await drain(server, settlement_task)
+    server.close()
     await server.wait_closed()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="BOT or NOT? game server")
+    parser.add_argument('--simulate', action='store_true', help="play games against simulated players on virtual time instead of serving")
+    parser.add_argument('--games', type=int, default=10, help="games to simulate")
+    parser.add_argument('--players', type=int, default=6, help="simulated players")
+    parser.add_argument('--seed', type=int, default=0, help="rng seed for the simulation")
+    parser.add_argument('--replay', help="replay a session recorded with SESSION_RECORD_PATH instead of using simulated players")
+    parser.add_argument('--verbose', action='store_true', help="show the server log during a simulation")
+    args = parser.parse_args()
+    
+    if args.simulate:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            summary = asyncio.run(run_simulation(args.games, args.players, args.seed, args.replay))
+        print(json.dumps(summary, indent=2))
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+from collections import OrderedDict
+from typing import Dict, List
+
+
+class PromptLibrary:
+    """Submitted persona prompts, deduplicated and persisted to disk.
+
+    Prompts are deduplicated on a hash of their normalized text (case and
+    whitespace insensitive). They are kept in insertion order for eviction and
+    in a flat list for O(1) random picks. The file is only read the first
+    time the library is used. Without a path nothing is read or written.
+    """
+
+    def __init__(self, path: str, max_size: int, save_delay: float = 2.0):
+        self.path = path
+        self.max_size = max_size
+        self.save_delay = save_delay
+        self.loaded = False
+        self.order: "OrderedDict[bytes, None]" = OrderedDict()  # digest -> None, oldest first
+        self.prompts: List[str] = []                            # for rng.choice
+        self.positions: Dict[bytes, int] = {}                   # digest -> index in prompts
+        self.save_handle = None
+
+    @staticmethod
+    def digest(prompt: str) -> bytes:
+        normalized = ' '.join(prompt.split()).casefold()
+        return hashlib.sha1(normalized.encode('utf-8')).digest()
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Could not load prompt library from {self.path}: {e}")
+            return
+        for prompt in stored:
+            if isinstance(prompt, str):
+                self._insert(prompt)
+        print(f"Loaded {len(self.prompts)} prompts from {self.path}")
+
+    def _insert(self, prompt: str) -> bool:
+        key = self.digest(prompt)
+        if key in self.positions:
+            # Resubmitting a prompt keeps it from being evicted
+            self.order.move_to_end(key)
+            return False
+        
+        self.order[key] = None
+        self.positions[key] = len(self.prompts)
+        self.prompts.append(prompt)
+        
+        while len(self.prompts) > self.max_size:
+            oldest, _ = self.order.popitem(last=False)
+            self._remove(oldest)
+        return True
+
+    def _remove(self, key: bytes):
+        # Swap with the last prompt so removal stays O(1)
+        index = self.positions.pop(key)
+        last = self.prompts.pop()
+        if index < len(self.prompts):
+            self.prompts[index] = last
+            self.positions[self.digest(last)] = index
+
+    def add(self, prompt: str) -> bool:
+        """Add a prompt. Returns False if an equivalent prompt was already stored."""
+        self._ensure_loaded()
+        added = self._insert(prompt)
+        if added:
+            self._schedule_save()
+        return added
+
+    def choice(self, rng: random.Random):
+        """Pick a random prompt, or None if the library is empty"""
+        self._ensure_loaded()
+        return rng.choice(self.prompts) if self.prompts else None
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self.prompts)
+
+    def _schedule_save(self):
+        if not self.path or self.save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        self.save_handle = loop.call_later(self.save_delay, self.save)
+
+    def save(self):
+        """Write the library to disk, oldest first"""
+        self.save_handle = None
+        if not self.path:
+            return
+        ordered = [self.prompts[self.positions[key]] for key in self.order]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(ordered, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save prompt library to {self.path}: {e}")
@@ -0,0 +1,317 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from typing import Any, Dict, List
+
+# web3 is optional, on-chain settlement is only available when it's installed
+try:
+    from web3 import Web3
+    from web3.exceptions import TransactionNotFound
+except ImportError:
+    Web3 = None
+
+    class TransactionNotFound(Exception):
+        pass
+
+GAS_BUMP = 1.125  # Minimum fee increase nodes accept for a replacement transaction
+
+# Only the function the server calls
+BOT_OR_NOT_ENDGAME_ABI = [{
+    "name": "endGame",
+    "type": "function",
+    "stateMutability": "nonpayable",
+    "inputs": [
+        {"name": "gameId", "type": "string"},
+        {"name": "aiPlayer", "type": "address"}
+    ],
+    "outputs": []
+}]
+
+class SettlementQueue:
+    """Persistent queue of endGame submissions with local nonce management.
+
+    Jobs move pending -> sent -> confirmed (dropped) or failed. Every state
+    change is written to disk, so pending and in-flight transactions survive a
+    restart and in-flight ones keep their nonce when they're resent. A resend
+    replaces the transaction but any earlier one may still be mined, so every
+    hash sent for the nonce is kept and checked.
+
+    A nonce is only claimed once its transaction has been built, and one
+    released by a job that never sent it is handed to the next job, so a bad
+    job can't leave a gap that every later transaction waits behind. With no
+    path, nothing is persisted.
+    """
+
+    def __init__(self, path: str = None, rpc_url: str = "", contract_address: str = "", private_key: str = "",
+                 batch_size: int = 10, max_attempts: int = 8, poll_interval: float = 2.0, receipt_timeout: float = 120.0):
+        self.path = path
+        self.rpc_url = rpc_url
+        self.contract_address = contract_address
+        self.private_key = private_key
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.receipt_timeout = receipt_timeout
+        self.jobs: List[Dict[str, Any]] = []
+        self.wakeup = asyncio.Event()
+        self.dirty = False
+        self.w3 = None
+        self.contract = None
+        self.account = None
+        self.chain_id = None
+        self.next_nonce = None
+        self.free_nonces: List[int] = []  # heap of nonces below next_nonce that no job holds
+        self.stopping = False
+
+    def enabled(self) -> bool:
+        return bool(Web3 and self.rpc_url and self.contract_address and self.private_key)
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.jobs = json.load(f)
+        except FileNotFoundError:
+            self.jobs = []
+        except (OSError, ValueError) as e:
+            print(f"Could not load settlement queue from {self.path}: {e}")
+            self.jobs = []
+        for job in self.jobs:
+            job.setdefault('txHashes', [job['txHash']] if job.get('txHash') else [])
+        if self.jobs:
+            print(f"Loaded {len(self.jobs)} unsettled games from {self.path}")
+
+    def save(self):
+        self.dirty = False
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.jobs, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save settlement queue to {self.path}: {e}")
+
+    def enqueue(self, game_id: str, ai_player_address: str):
+        """Queue a game result for submission. Cheap enough to call from the game loop."""
+        if not ai_player_address:
+            print(f"Game {game_id} has no AI wallet address, skipping settlement")
+            return
+        # Checked here, before the job can hold a nonce
+        if Web3 is None or not Web3.is_address(ai_player_address):
+            print(f"Game {game_id} has an invalid AI wallet address {ai_player_address!r}, skipping settlement")
+            return
+        self.jobs.append({
+            'id': f"{game_id}:{int(time.time() * 1000)}",
+            'gameId': game_id,
+            'aiPlayerAddress': Web3.to_checksum_address(ai_player_address),
+            'status': 'pending',
+            'attempts': 0,
+            'nonce': None,
+            'gasPrice': None,
+            'txHash': None,
+            'txHashes': [],
+            'sentAt': None,
+            'nextAttemptAt': 0,
+            'lastError': None
+        })
+        # Written straight away, the game result exists nowhere else
+        self.save()
+        self.wakeup.set()
+
+    def _connect(self):
+        self.w3 = Web3(Web3.HTTPProvider(self.rpc_url))
+        self.account = self.w3.eth.account.from_key(self.private_key)
+        self.contract = self.w3.eth.contract(
+            address=Web3.to_checksum_address(self.contract_address), abi=BOT_OR_NOT_ENDGAME_ABI
+        )
+        self.chain_id = self.w3.eth.chain_id
+        self._sync_nonce()
+        print(f"Settlement connected to chain {self.chain_id} as {self.account.address}")
+
+    def _sync_nonce(self):
+        # Nonces held by in-flight jobs, or by jobs waiting to resend or retry,
+        # must not be handed out again. Unheld ones between the chain's count
+        # and the highest held nonce are gaps to fill first.
+        chain_nonce = self.w3.eth.get_transaction_count(self.account.address, 'pending')
+        held = {job['nonce'] for job in self.jobs if job['status'] in ('pending', 'sent') and job['nonce'] is not None}
+        self.next_nonce = max([chain_nonce] + [n + 1 for n in held])
+        self.free_nonces = [n for n in range(chain_nonce, self.next_nonce) if n not in held]
+        heapq.heapify(self.free_nonces)
+
+    def _release_nonce(self, job: Dict[str, Any]):
+        """Give up a nonce the job never sent a transaction with, for the next job to use"""
+        if job['nonce'] is not None and not job['txHashes']:
+            heapq.heappush(self.free_nonces, job['nonce'])
+        job['nonce'] = None
+
+    def _send(self, job: Dict[str, Any]):
+        """Sign and send one endGame transaction (blocking, runs in an executor)"""
+        nonce = job['nonce']
+        if nonce is None:
+            nonce = self.free_nonces[0] if self.free_nonces else self.next_nonce
+        
+        gas_price = self.w3.eth.gas_price
+        if job['gasPrice']:
+            # Replacing a stuck transaction, the node wants a higher fee
+            gas_price = max(gas_price, int(job['gasPrice'] * GAS_BUMP) + 1)
+        
+        tx = self.contract.functions.endGame(
+            job['gameId'], Web3.to_checksum_address(job['aiPlayerAddress'])
+        ).build_transaction({
+            'from': self.account.address,
+            'nonce': nonce,
+            'chainId': self.chain_id,
+            'gasPrice': gas_price
+        })
+        signed = self.account.sign_transaction(tx)
+        raw = getattr(signed, 'raw_transaction', None) or signed.rawTransaction
+        
+        # Claim the nonce now the transaction exists. If sending fails the job
+        # keeps it and retries with it.
+        if job['nonce'] is None:
+            if self.free_nonces and self.free_nonces[0] == nonce:
+                heapq.heappop(self.free_nonces)
+            else:
+                self.next_nonce += 1
+            job['nonce'] = nonce
+        tx_hash = self.w3.eth.send_raw_transaction(raw)
+        
+        job['gasPrice'] = gas_price
+        job['txHash'] = tx_hash.hex()
+        job['txHashes'].append(job['txHash'])
+        job['sentAt'] = time.time()
+        job['status'] = 'sent'
+
+    def _receipt(self, job: Dict[str, Any]):
+        """Fetch the receipt of whichever of a job's transactions was mined, or None (blocking)"""
+        for tx_hash in job['txHashes']:
+            try:
+                receipt = self.w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            job['txHash'] = tx_hash
+            return receipt
+        return None
+
+    def _fail_attempt(self, job: Dict[str, Any], error: Exception):
+        job['attempts'] += 1
+        job['lastError'] = f"{type(error).__name__}: {error}"
+        if job['attempts'] >= self.max_attempts:
+            job['status'] = 'failed'
+            print(f"Giving up on settlement for game {job['gameId']}: {job['lastError']}")
+            # An unsent nonce goes to the next job so later transactions don't
+            # queue up behind a gap. A sent one may still be mined, keep it.
+            if not job['txHashes']:
+                self._release_nonce(job)
+            return
+        
+        message = str(error).lower()
+        if job['txHashes'] and ('nonce' in message or 'underpriced' in message):
+            # A resend was refused, most likely because an earlier transaction for
+            # this nonce is mined or still pending. Keep watching those rather
+            # than moving to a new nonce and settling the game twice.
+            job['status'] = 'sent'
+            job['sentAt'] = time.time()
+            print(f"Resend for game {job['gameId']} refused, waiting on earlier transactions: {job['lastError']}")
+            return
+        
+        job['status'] = 'pending'
+        job['nextAttemptAt'] = time.time() + min(2 ** job['attempts'], 300)
+        print(f"Settlement for game {job['gameId']} failed (attempt {job['attempts']}), retrying: {job['lastError']}")
+        
+        if 'nonce' in message or 'underpriced' in message:
+            # Our view of the nonce drifted from the node's, start over from the chain
+            job['nonce'] = None
+            job['gasPrice'] = None
+            self._sync_nonce()
+
+    async def _run_cycle(self, loop):
+        now = time.time()
+        
+        # Check in-flight transactions
+        for job in [j for j in self.jobs if j['status'] == 'sent']:
+            receipt = await loop.run_in_executor(None, self._receipt, job)
+            if receipt is None:
+                if now - job['sentAt'] > self.receipt_timeout:
+                    # Stuck in the mempool, resend with the same nonce and a bumped fee
+                    job['status'] = 'pending'
+                    self.dirty = True
+                continue
+            
+            self.dirty = True
+            if receipt['status'] == 1:
+                job['status'] = 'confirmed'
+                print(f"Settled game {job['gameId']} in tx {job['txHash']}")
+            else:
+                # The nonce is used up, a retry is a new transaction
+                job['nonce'] = None
+                job['gasPrice'] = None
+                job['txHashes'] = []
+                self._fail_attempt(job, RuntimeError(f"transaction {job['txHash']} reverted"))
+        
+        # Send the next batch, each with its own nonce, without waiting for confirmations
+        due = [j for j in self.jobs if j['status'] == 'pending' and j['nextAttemptAt'] <= now]
+        for job in due[:self.batch_size]:
+            try:
+                await loop.run_in_executor(None, self._send, job)
+                print(f"Submitted endGame for game {job['gameId']} (nonce {job['nonce']})")
+            except Exception as e:
+                self._fail_attempt(job, e)
+            self.dirty = True
+        
+        # Confirmed jobs don't need to survive a restart
+        self.jobs = [j for j in self.jobs if j['status'] != 'confirmed']
+
+    def adopt(self, jobs: List[Dict[str, Any]]):
+        """Take over jobs from a process that is shutting down"""
+        known = {job['id'] for job in self.jobs}
+        adopted = [job for job in jobs if job['id'] not in known]
+        self.jobs.extend(adopted)
+        self.save()
+        # Reconnect so the nonce is resynced past the adopted in-flight transactions
+        self.w3 = None
+        self.wakeup.set()
+        print(f"Adopted {len(adopted)} settlement jobs")
+
+    async def stop(self, task: asyncio.Task) -> List[Dict[str, Any]]:
+        """Stop the worker after its current cycle and return the unsettled jobs"""
+        self.stopping = True
+        self.wakeup.set()
+        try:
+            await asyncio.wait_for(task, timeout=self.poll_interval * 2)
+        except asyncio.TimeoutError:
+            print("Settlement worker did not stop in time")
+        self.save()
+        return self.jobs
+
+    async def run(self):
+        """Worker loop, started from main()"""
+        self.load()
+        if not self.enabled():
+            if self.jobs:
+                print(f"Settlement disabled, {len(self.jobs)} queued games will be kept for later")
+            return
+        
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            try:
+                if self.w3 is None:
+                    await loop.run_in_executor(None, self._connect)
+                await self._run_cycle(loop)
+            except Exception as e:
+                print(f"Settlement worker error: {type(e).__name__}: {e}")
+                self.w3 = None  # Reconnect on the next cycle
+            
+            if self.dirty:
+                self.save()
+            
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,2 @@
+def pytest_configure(config):
+    config.addinivalue_line("markers", "anvil: needs a local dev chain, see test_settlement.py")
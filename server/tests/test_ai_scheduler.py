@@ -0,0 +1,162 @@
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ai_scheduler import AIScheduler
+from clocks import VirtualClock
+
+EPOCH = 1_700_000_000.0
+
+
+class Game:
+    """Just enough of a game for the scheduler: every turn takes `latency` seconds of virtual time"""
+
+    def __init__(self, clock, latency=1.0):
+        self.clock = clock
+        self.latency = latency
+        self.generated = []   # room ids, in the order the model was called
+        self.sent = []        # (room id, text)
+
+    def room(self, room_id, phase_left=60.0, last_spoke=None, prompt="a pirate"):
+        return {
+            'roomId': room_id, 'active': True, 'messages': [], 'aiPrompt': prompt,
+            'phaseEndsAt': self.clock.time() + phase_left, 'aiLastSpokeAt': last_spoke,
+        }
+
+    async def generate(self, room):
+        self.generated.append(room['roomId'])
+        await self.clock.sleep(self.latency)
+        return f"reply {len(self.generated)} for {room['roomId']}"
+
+    async def send(self, room, text):
+        self.sent.append((room['roomId'], text))
+        room['messages'].append({'text': text})
+
+    def scheduler(self, **kwargs):
+        return AIScheduler(
+            self.clock, random.Random(0), self.generate, self.send,
+            wants_turn=lambda room: room['active'],
+            estimate_tokens=lambda room: 100,
+            fallback=lambda: "stock line",
+            **kwargs,
+        )
+
+
+def run(clock, scheduler, main, limit=600):
+    async def driver():
+        worker = asyncio.ensure_future(scheduler.run())
+        task = asyncio.ensure_future(main())
+        await clock.run_until(task.done, limit)
+        worker.cancel()
+        return task.result() if task.done() else None
+    return asyncio.run(driver())
+
+
+def test_earliest_deadline_is_served_first():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock)
+    scheduler = game.scheduler(max_concurrent=1)
+
+    async def main():
+        for room in [game.room('late', 50), game.room('soon', 20), game.room('middle', 35)]:
+            scheduler.request(room)
+        await clock.sleep(10)
+
+    run(clock, scheduler, main)
+    assert game.generated == ['soon', 'middle', 'late']
+
+
+def test_longer_silence_and_first_turns_come_first():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock)
+    scheduler = game.scheduler(max_concurrent=1)
+
+    async def main():
+        scheduler.request(game.room('chatty', 30, last_spoke=clock.time() - 1))
+        scheduler.request(game.room('quiet', 30, last_spoke=clock.time() - 20))
+        scheduler.request(game.room('new', 40))
+        await clock.sleep(10)
+
+    run(clock, scheduler, main)
+    assert game.generated == ['new', 'quiet', 'chatty']
+
+
+def test_requests_are_merged_and_dropped_when_unwanted():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock)
+    scheduler = game.scheduler(max_concurrent=1)
+    busy, merged, finished = game.room('busy'), game.room('merged'), game.room('finished')
+
+    async def main():
+        scheduler.request(busy)
+        await asyncio.sleep(0)
+        scheduler.request(merged)
+        scheduler.request(merged)
+        scheduler.request(finished)
+        finished['active'] = False
+        await clock.sleep(10)
+
+    run(clock, scheduler, main)
+    assert game.generated == ['busy', 'merged']
+    assert scheduler.counts == {'served': 2, 'dropped': 1}
+
+
+def test_turns_out_of_time_are_shed_to_cached_replies():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock, latency=5.0)
+    scheduler = game.scheduler(max_concurrent=1, deadline_margin=2.0)
+
+    async def main():
+        scheduler.request(game.room('first', 60))
+        await clock.sleep(10)
+        # Latency is now estimated at 3.4 seconds, which with the margin doesn't fit in 5
+        scheduler.request(game.room('hurried', 5))
+        scheduler.request(game.room('other persona', 5, prompt="a librarian"))
+        await clock.sleep(1)
+
+    run(clock, scheduler, main)
+    assert game.generated == ['first']
+    assert sorted(game.sent) == [
+        ('first', 'reply 1 for first'),
+        ('hurried', 'reply 1 for first'),
+        ('other persona', 'stock line'),
+    ]
+    assert scheduler.counts == {'served': 1, 'shed': 2}
+
+
+def test_request_budget_spaces_out_model_calls():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock, latency=0.1)
+    scheduler = game.scheduler(requests_per_minute=6)  # One call every 10 seconds after a burst of one
+    started = []
+
+    async def generate(room):
+        started.append(clock.monotonic())
+        return "hi"
+    scheduler.generate = generate
+
+    async def main():
+        for name in ['a', 'b', 'c']:
+            scheduler.request(game.room(name, 120))
+        await clock.sleep(30)
+
+    run(clock, scheduler, main)
+    assert [round(t) for t in started] == [0, 10, 20]
+
+
+def test_typing_delay_is_waited_out_on_the_clock():
+    clock = VirtualClock(EPOCH)
+    game = Game(clock)
+    scheduler = game.scheduler()
+
+    async def main():
+        scheduler.request(game.room('typing'), delay=2.5)
+        scheduler.request(game.room('typing'))  # Already waiting, merged
+        await clock.sleep(10)
+
+    run(clock, scheduler, main)
+    assert game.generated == ['typing']
+    assert clock.monotonic() >= 2.5
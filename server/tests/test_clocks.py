@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from clocks import VirtualClock
+
+EPOCH = 1_700_000_000.0
+
+
+def run(clock, main, limit=float('inf')):
+    async def driver():
+        task = asyncio.ensure_future(main())
+        await clock.run_until(task.done, limit)
+        return task.result() if task.done() else None
+    return asyncio.run(driver())
+
+
+def test_sleep_jumps_to_the_deadline():
+    clock = VirtualClock(EPOCH)
+
+    async def main():
+        await clock.sleep(3600)
+        return clock.time()
+
+    assert run(clock, main) == EPOCH + 3600
+    assert clock.monotonic() == 3600
+
+
+def test_short_timers_at_epoch_scale_still_advance():
+    # Delays far below the float resolution of an epoch timestamp used to round
+    # away, so the clock never moved and the simulation spun forever
+    clock = VirtualClock(EPOCH)
+
+    async def main():
+        for _ in range(1000):
+            await clock.sleep(1e-7)
+        return clock.monotonic()
+
+    assert abs(run(clock, main) - 1e-4) < 1e-9
+
+
+def test_ties_wake_in_scheduling_order():
+    clock = VirtualClock(EPOCH)
+    woke = []
+
+    async def sleeper(name, delay):
+        await clock.sleep(delay)
+        woke.append(name)
+
+    async def main():
+        await asyncio.gather(sleeper('a', 2), sleeper('b', 1), sleeper('c', 2), sleeper('d', 1))
+
+    run(clock, main)
+    assert woke == ['b', 'd', 'a', 'c']
+
+
+def test_wait_for_times_out_on_virtual_time():
+    clock = VirtualClock(EPOCH)
+
+    async def main():
+        try:
+            await clock.wait_for(clock.sleep(10), timeout=5)
+        except asyncio.TimeoutError:
+            return clock.monotonic()
+
+    assert run(clock, main) == 5
+
+
+def test_run_until_stops_at_the_limit():
+    clock = VirtualClock(EPOCH)
+
+    async def main():
+        while True:
+            await clock.sleep(1)
+
+    run(clock, main, limit=10)
+    assert clock.monotonic() == 10
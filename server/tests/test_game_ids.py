@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from game_ids import GameIdCounter
+
+
+def test_in_memory_ids_count_up_from_the_seed():
+    counter = GameIdCounter(seed=lambda: 7)
+    assert [counter.next() for _ in range(3)] == ["7", "8", "9"]
+
+
+def test_ids_carry_on_after_a_restart(tmp_path):
+    path = str(tmp_path / "game_id_counter")
+    assert [GameIdCounter(path).next() for _ in range(2)] == ["1", "2"]
+    assert GameIdCounter(path, seed=lambda: 100).next() == "3"
+
+
+def test_processes_sharing_the_file_never_hand_out_the_same_id(tmp_path):
+    path = str(tmp_path / "game_id_counter")
+    old, new = GameIdCounter(path), GameIdCounter(path)
+    handed_out = [old.next(), new.next(), old.next(), new.next()]
+    assert handed_out == ["1", "2", "3", "4"]
+
+
+def test_seed_is_only_used_for_a_missing_or_corrupt_file(tmp_path):
+    path = tmp_path / "game_id_counter"
+    seeds = []
+    
+    def seed():
+        seeds.append(None)
+        return 40
+    
+    counter = GameIdCounter(str(path), seed=seed)
+    assert counter.next() == "40"
+    assert counter.next() == "41"
+    path.write_text("garbage")
+    assert counter.next() == "42"  # Reseeded, but never below an id already handed out
+    assert len(seeds) == 2
+
+
+def test_falls_back_to_counting_in_memory(tmp_path):
+    counter = GameIdCounter(str(tmp_path / "missing-dir" / "game_id_counter"), seed=lambda: 5)
+    assert [counter.next(), counter.next()] == ["5", "6"]
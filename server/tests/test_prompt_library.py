@@ -0,0 +1,94 @@
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from prompt_library import PromptLibrary
+
+
+def check_index(library):
+    assert len(library.prompts) == len(library.positions) == len(library.order)
+    for key, index in library.positions.items():
+        assert PromptLibrary.digest(library.prompts[index]) == key
+    assert set(library.order) == set(library.positions)
+
+
+def test_dedup_ignores_case_and_whitespace(tmp_path):
+    library = PromptLibrary(str(tmp_path / "prompts.json"), 10)
+    assert library.add("A grumpy  pirate")
+    assert not library.add("  a GRUMPY pirate\n")
+    assert not library.add("a grumpy pirate")
+    assert library.add("a grumpy parrot")
+    assert len(library) == 2
+    check_index(library)
+
+
+def test_oldest_prompt_is_evicted_first(tmp_path):
+    library = PromptLibrary(str(tmp_path / "prompts.json"), 3)
+    for prompt in ["one", "two", "three", "four"]:
+        library.add(prompt)
+    assert sorted(library.prompts) == ["four", "three", "two"]
+    check_index(library)
+
+
+def test_resubmitting_keeps_a_prompt_from_eviction(tmp_path):
+    library = PromptLibrary(str(tmp_path / "prompts.json"), 3)
+    for prompt in ["one", "two", "three"]:
+        library.add(prompt)
+    library.add("ONE")
+    library.add("four")
+    assert sorted(library.prompts) == ["four", "one", "three"]
+    check_index(library)
+
+
+def test_swap_removal_keeps_the_index_consistent(tmp_path):
+    rnd = random.Random(7)
+    library = PromptLibrary(str(tmp_path / "prompts.json"), 25)
+    for _ in range(2000):
+        library.add(f"prompt {rnd.randrange(100)}")
+        check_index(library)
+    assert len(library) == 25
+
+
+def test_choice(tmp_path):
+    library = PromptLibrary(str(tmp_path / "prompts.json"), 10)
+    assert library.choice(random.Random(1)) is None
+    library.add("one")
+    library.add("two")
+    picks = {library.choice(random.Random(seed)) for seed in range(20)}
+    assert picks == {"one", "two"}
+
+
+def test_saves_oldest_first_and_reloads(tmp_path):
+    path = str(tmp_path / "prompts.json")
+    library = PromptLibrary(path, 3)
+    for prompt in ["one", "two", "three", "four"]:
+        library.add(prompt)  # No running loop, so each add saves straight away
+    library.add("two")  # Only reorders, which isn't worth a write of its own
+    library.save()
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == ["three", "four", "two"]
+
+    reloaded = PromptLibrary(path, 3)
+    assert len(reloaded) == 3
+    check_index(reloaded)
+    reloaded.add("five")
+    assert sorted(reloaded.prompts) == ["five", "four", "two"]
+
+
+def test_unreadable_file_starts_empty(tmp_path):
+    path = tmp_path / "prompts.json"
+    path.write_text("not json")
+    library = PromptLibrary(str(path), 3)
+    assert len(library) == 0
+
+
+def test_without_a_path_nothing_touches_disk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    library = PromptLibrary(None, 3)
+    assert library.add("one")
+    library.save()
+    assert len(library) == 1
+    assert os.listdir(tmp_path) == []
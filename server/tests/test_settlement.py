@@ -0,0 +1,265 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import settlement
+from settlement import SettlementQueue
+
+pytestmark = pytest.mark.skipif(settlement.Web3 is None, reason="web3 is not installed")
+
+AI_ADDRESS = "0x" + "ab" * 20
+
+
+class FakeEth:
+    def __init__(self):
+        self.chain_nonce = 5
+        self.gas_price = 100
+        self.chain_id = 31337
+        self.sent = []            # (nonce, gas price, game id) per accepted transaction
+        self.receipts = {}        # hash -> receipt
+        self.send_errors = []     # raised by the next sends, in order
+
+    def get_transaction_count(self, address, block):
+        return self.chain_nonce
+
+    def send_raw_transaction(self, raw):
+        if self.send_errors:
+            raise self.send_errors.pop(0)
+        self.sent.append((raw['nonce'], raw['gasPrice'], raw['gameId']))
+        return f"{raw['gameId']}-{raw['nonce']}-{raw['gasPrice']}".encode()
+
+    def get_transaction_receipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise settlement.TransactionNotFound(tx_hash)
+        return self.receipts[tx_hash]
+
+    def mine(self, tx_hash, status=1):
+        self.receipts[tx_hash] = {'status': status}
+
+
+class FakeCall:
+    def __init__(self, game_id, ai_player, broken):
+        self.game_id = game_id
+        self.broken = broken
+
+    def build_transaction(self, params):
+        if self.game_id in self.broken:
+            raise ValueError("could not build")
+        return dict(params, gameId=self.game_id)
+
+
+class FakeContract:
+    def __init__(self):
+        self.broken = set()
+        self.functions = self
+
+    def endGame(self, game_id, ai_player):
+        return FakeCall(game_id, ai_player, self.broken)
+
+
+class FakeSigned:
+    def __init__(self, tx):
+        self.raw_transaction = tx
+
+
+class FakeAccount:
+    address = "0x" + "11" * 20
+
+    def sign_transaction(self, tx):
+        return FakeSigned(tx)
+
+
+class FakeW3:
+    def __init__(self):
+        self.eth = FakeEth()
+
+
+def connected_queue(tmp_path, **kwargs):
+    queue = SettlementQueue(str(tmp_path / "queue.json"), **kwargs)
+    queue.w3 = FakeW3()
+    queue.contract = FakeContract()
+    queue.account = FakeAccount()
+    queue.chain_id = queue.w3.eth.chain_id
+    queue._sync_nonce()
+    return queue
+
+
+def cycle(queue):
+    async def run():
+        await queue._run_cycle(asyncio.get_running_loop())
+    asyncio.run(run())
+
+
+def tx_hash(game_id, nonce, gas_price):
+    return f"{game_id}-{nonce}-{gas_price}".encode().hex()
+
+
+def job_for(queue, game_id):
+    return next(job for job in queue.jobs if job['gameId'] == game_id)
+
+
+def test_nonces_are_allocated_in_order(tmp_path):
+    queue = connected_queue(tmp_path)
+    for game_id in ["1", "2", "3"]:
+        queue.enqueue(game_id, AI_ADDRESS)
+    cycle(queue)
+    assert [nonce for nonce, _, _ in queue.w3.eth.sent] == [5, 6, 7]
+    assert all(job['status'] == 'sent' for job in queue.jobs)
+    
+    queue.w3.eth.mine(tx_hash("2", 6, 100))
+    cycle(queue)
+    assert [job['gameId'] for job in queue.jobs] == ["1", "3"]
+
+
+def test_invalid_address_is_rejected_on_enqueue(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.enqueue("1", "not-an-address")
+    queue.enqueue("2", AI_ADDRESS.lower())
+    assert [job['gameId'] for job in queue.jobs] == ["2"]
+    assert queue.jobs[0]['aiPlayerAddress'] == settlement.Web3.to_checksum_address(AI_ADDRESS)
+
+
+def test_a_transaction_that_fails_to_build_holds_no_nonce(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.contract.broken.add("1")
+    queue.enqueue("1", AI_ADDRESS)
+    queue.enqueue("2", AI_ADDRESS)
+    cycle(queue)
+    assert job_for(queue, "1")['nonce'] is None
+    assert queue.w3.eth.sent == [(5, 100, "2")]
+
+
+def test_a_job_giving_up_hands_its_nonce_on(tmp_path):
+    queue = connected_queue(tmp_path, max_attempts=1)
+    queue.w3.eth.send_errors.append(ConnectionError("node went away"))
+    queue.enqueue("1", AI_ADDRESS)
+    cycle(queue)
+    assert job_for(queue, "1")['status'] == 'failed'
+    assert job_for(queue, "1")['nonce'] is None
+    
+    queue.enqueue("2", AI_ADDRESS)
+    queue.enqueue("3", AI_ADDRESS)
+    cycle(queue)
+    assert queue.w3.eth.sent == [(5, 100, "2"), (6, 100, "3")]
+
+
+def test_sync_skips_held_nonces_and_fills_gaps(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.jobs = [
+        {'status': 'sent', 'nonce': 5}, {'status': 'pending', 'nonce': 7},
+        {'status': 'failed', 'nonce': 9}, {'status': 'pending', 'nonce': None},
+    ]
+    queue._sync_nonce()
+    assert queue.next_nonce == 8
+    assert sorted(queue.free_nonces) == [6]
+
+
+def test_stuck_transaction_is_resent_with_a_bumped_fee(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.enqueue("1", AI_ADDRESS)
+    cycle(queue)
+    job = job_for(queue, "1")
+    job['sentAt'] = time.time() - queue.receipt_timeout - 1
+    
+    cycle(queue)
+    assert [(nonce, gas) for nonce, gas, _ in queue.w3.eth.sent] == [(5, 100), (5, 113)]
+    assert job['txHashes'] == [tx_hash("1", 5, 100), tx_hash("1", 5, 113)]
+    
+    # The original transaction is the one that got mined
+    queue.w3.eth.mine(tx_hash("1", 5, 100))
+    cycle(queue)
+    assert queue.jobs == []
+    assert len(queue.w3.eth.sent) == 2
+
+
+def test_refused_resend_keeps_waiting_on_the_nonce(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.enqueue("1", AI_ADDRESS)
+    cycle(queue)
+    job = job_for(queue, "1")
+    job['sentAt'] = time.time() - queue.receipt_timeout - 1
+    queue.w3.eth.send_errors.append(ValueError("nonce too low"))
+    
+    cycle(queue)
+    assert job['status'] == 'sent'
+    assert job['nonce'] == 5
+    assert job['txHashes'] == [tx_hash("1", 5, 100)]
+    assert queue.next_nonce == 6
+
+
+def test_reverted_transaction_is_retried_on_a_new_nonce(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.enqueue("1", AI_ADDRESS)
+    cycle(queue)
+    queue.w3.eth.mine(tx_hash("1", 5, 100), status=0)
+    queue.w3.eth.chain_nonce = 6
+    cycle(queue)
+    job = job_for(queue, "1")
+    assert job['status'] == 'pending' and job['nonce'] is None and job['txHashes'] == []
+
+
+def test_jobs_are_saved_on_enqueue_and_reloaded(tmp_path):
+    queue = connected_queue(tmp_path)
+    queue.enqueue("1", AI_ADDRESS)
+    with open(queue.path, encoding='utf-8') as f:
+        assert [job['gameId'] for job in json.load(f)] == ["1"]
+    
+    cycle(queue)
+    queue.save()
+    reloaded = SettlementQueue(queue.path)
+    reloaded.load()
+    assert reloaded.jobs == queue.jobs
+
+
+def test_jobs_saved_before_tx_hashes_were_kept_still_load(tmp_path):
+    path = tmp_path / "queue.json"
+    path.write_text(json.dumps([{'id': '1:0', 'gameId': '1', 'status': 'sent', 'nonce': 3, 'txHash': 'aa'}]))
+    queue = SettlementQueue(str(path))
+    queue.load()
+    assert queue.jobs[0]['txHashes'] == ['aa']
+
+
+def test_without_a_path_nothing_is_written(tmp_path):
+    queue = SettlementQueue(None)
+    assert not queue.enabled()
+    queue.enqueue("1", AI_ADDRESS)
+    queue.load()
+    assert len(queue.jobs) == 1
+
+
+ANVIL_ENV = ("SETTLEMENT_TEST_RPC_URL", "SETTLEMENT_TEST_CONTRACT_ADDRESS", "SETTLEMENT_TEST_PRIVATE_KEY")
+
+
+@pytest.mark.anvil
+@pytest.mark.skipif(not all(os.environ.get(name) for name in ANVIL_ENV), reason="needs a dev chain, set " + ", ".join(ANVIL_ENV))
+def test_settles_on_a_dev_chain(tmp_path):
+    # Start anvil, deploy BotOrNotGame from smart_contracts/ and point the
+    # variables above at it (any funded anvil key works)
+    rpc_url, contract_address, private_key = (os.environ[name] for name in ANVIL_ENV)
+    queue = SettlementQueue(str(tmp_path / "queue.json"), rpc_url, contract_address, private_key, poll_interval=0.2)
+    game_ids = [f"settlement-test-{int(time.time() * 1000)}-{i}" for i in range(3)]
+    for game_id in game_ids:
+        queue.enqueue(game_id, AI_ADDRESS)
+    
+    async def run():
+        task = asyncio.create_task(queue.run())
+        deadline = time.monotonic() + 30
+        while queue.jobs and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await queue.stop(task)
+    # run() reloads the saved queue, which already holds the jobs
+    asyncio.run(run())
+    assert queue.jobs == []
+    
+    contract = queue.w3.eth.contract(
+        address=settlement.Web3.to_checksum_address(contract_address),
+        abi=[{"name": "getGameState", "type": "function", "stateMutability": "view",
+              "inputs": [{"name": "gameId", "type": "string"}], "outputs": [{"name": "", "type": "uint8"}]}],
+    )
+    assert [contract.functions.getGameState(game_id).call() for game_id in game_ids] == [2, 2, 2]
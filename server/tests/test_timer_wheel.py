@@ -0,0 +1,108 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from timer_wheel import TimerWheel
+
+
+def advance_until_expired(wheel, key, now, step, limit):
+    while now < limit:
+        now += step
+        if key in wheel.advance(now):
+            return now
+    return None
+
+
+def test_expires_on_the_tick_it_is_due():
+    wheel = TimerWheel(resolution=1.0, now=100.0)
+    wheel.schedule("a", 103.0)
+    assert wheel.advance(102.9) == []
+    assert wheel.advance(103.0) == ["a"]
+    assert wheel.advance(200.0) == []
+
+
+def test_deadline_later_in_the_current_tick():
+    # Advancing to 105.2 visits tick 105 while the 105.7 deadline is still ahead
+    wheel = TimerWheel(resolution=1.0, now=101.0)
+    wheel.schedule("a", 105.7)
+    expired_at = advance_until_expired(wheel, "a", 101.2, 1.0, 200.0)
+    assert expired_at is not None
+    assert 105.7 <= expired_at < 107.0
+
+
+def test_reschedule_moves_the_deadline():
+    wheel = TimerWheel(resolution=1.0, now=0.0)
+    wheel.schedule("a", 5.0)
+    wheel.schedule("a", 10.0)
+    assert wheel.advance(6.0) == []
+    assert wheel.advance(10.0) == ["a"]
+
+
+def test_reschedule_back_into_an_old_slot():
+    wheel = TimerWheel(resolution=1.0, slots=8, now=0.0)
+    wheel.schedule("a", 3.0)
+    wheel.schedule("a", 11.0)  # same slot, next rotation
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(11.0) == ["a"]
+
+
+def test_cancel():
+    wheel = TimerWheel(resolution=1.0, now=0.0)
+    wheel.schedule("a", 2.0)
+    wheel.cancel("a")
+    assert wheel.advance(10.0) == []
+    assert not any(wheel.slots)
+
+
+def test_deadline_beyond_one_rotation():
+    wheel = TimerWheel(resolution=1.0, slots=8, now=0.0)
+    wheel.schedule("a", 20.5)
+    for now in range(1, 21):
+        assert wheel.advance(float(now)) == []
+    assert wheel.advance(21.0) == ["a"]
+
+
+def test_long_stall_expires_everything_due():
+    wheel = TimerWheel(resolution=1.0, slots=8, now=0.0)
+    for i in range(20):
+        wheel.schedule(str(i), 1.0 + i)
+    assert sorted(wheel.advance(100.0), key=int) == [str(i) for i in range(20)]
+
+
+def test_past_deadline_expires_on_next_tick():
+    wheel = TimerWheel(resolution=1.0, now=50.0)
+    wheel.schedule("a", 10.0)
+    assert wheel.advance(50.5) == []
+    assert wheel.advance(51.0) == ["a"]
+
+
+def test_randomized_against_reference():
+    # Reference model: a key is due on the first advance whose tick is at or
+    # past its deadline's tick (never the tick it was scheduled in) and whose
+    # time is at or past the deadline itself
+    rnd = random.Random(1234)
+    resolution = 0.5
+    wheel = TimerWheel(resolution=resolution, slots=16, now=0.0)
+    pending = {}
+    now = 0.0
+    for _ in range(5000):
+        action = rnd.random()
+        key = str(rnd.randrange(50))
+        if action < 0.5:
+            deadline = now + rnd.uniform(-1.0, 20.0)
+            wheel.schedule(key, deadline)
+            pending[key] = (deadline, max(int(deadline / resolution), int(now / resolution) + 1))
+        elif action < 0.6:
+            wheel.cancel(key)
+            pending.pop(key, None)
+        else:
+            now += rnd.uniform(0.0, 3.0) if rnd.random() < 0.95 else rnd.uniform(5.0, 30.0)
+            tick = int(now / resolution)
+            due = {k for k, (deadline, due_tick) in pending.items() if due_tick <= tick and deadline <= now}
+            expired = wheel.advance(now)
+            assert len(expired) == len(set(expired))
+            assert set(expired) == due
+            for k in expired:
+                del pending[k]
@@ -0,0 +1,97 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from vote_tally import VoteTally
+
+
+def make_tally(voters=('a', 'b', 'c')):
+    return VoteTally(voters, {v: v.upper() for v in voters})
+
+
+def test_completes_when_every_eligible_voter_has_voted():
+    tally = make_tally()
+    assert tally.remaining == 3 and not tally.complete()
+    tally.cast('a', 'b')
+    tally.cast('b', 'c')
+    assert tally.remaining == 1
+    tally.cast('c', 'b')
+    assert tally.complete()
+    assert tally.leader() == 'b'
+    assert tally.counts == {'b': 2, 'c': 1}
+
+
+def test_changing_a_vote_moves_it():
+    tally = make_tally()
+    tally.cast('a', 'b')
+    tally.cast('a', 'c')
+    assert tally.counts == {'c': 1}
+    assert tally.remaining == 2
+    assert tally.leader() == 'c'
+    tally.cast('a', 'c')  # same vote again changes nothing
+    assert tally.counts == {'c': 1} and tally.remaining == 2
+
+
+def test_ties_go_to_the_first_to_reach_the_count():
+    tally = make_tally(('a', 'b', 'c', 'd'))
+    tally.cast('a', 'x')
+    tally.cast('b', 'y')
+    assert tally.leader() == 'x'
+    tally.cast('c', 'y')
+    tally.cast('d', 'x')
+    assert tally.leader() == 'y'
+
+
+def test_leader_falls_back_when_the_top_count_empties():
+    tally = make_tally()
+    assert tally.leader() is None
+    tally.cast('a', 'x')
+    tally.cast('b', 'x')
+    tally.cast('c', 'y')
+    tally.cast('a', 'y')
+    tally.cast('b', 'z')
+    assert tally.max_count == 2
+    assert tally.leader() == 'y'
+
+
+def test_remove_voter():
+    tally = make_tally()
+    tally.cast('a', 'b')
+    tally.remove_voter('a')  # already voted, the vote still counts
+    assert tally.remaining == 2 and tally.counts == {'b': 1}
+    tally.remove_voter('b')
+    assert tally.remaining == 1
+    tally.remove_voter('b')
+    assert tally.remaining == 1
+    tally.cast('c', 'a')
+    assert tally.complete()
+
+
+def test_add_voter():
+    tally = make_tally(('a',))
+    tally.add_voter('b', 'B')
+    assert tally.remaining == 2
+    tally.add_voter('b', 'B')
+    assert tally.remaining == 2
+    tally.remove_voter('b')
+    tally.add_voter('b', 'B')
+    assert tally.remaining == 2
+    tally.cast('a', 'x')
+    tally.cast('b', 'x')
+    assert tally.complete()
+
+
+def test_rejoining_after_voting_is_not_waited_on():
+    tally = make_tally(('a', 'b'))
+    tally.cast('a', 'b')
+    tally.remove_voter('a')
+    tally.add_voter('a', 'A')
+    assert tally.remaining == 1
+
+
+def test_votes_from_ineligible_players_count_but_are_not_waited_on():
+    tally = make_tally(('a',))
+    tally.cast('z', 'a')
+    assert tally.counts == {'a': 1}
+    assert tally.remaining == 1
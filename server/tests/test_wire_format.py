@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from wire_format import WIRE_FIELD_IDS, WIRE_TYPE_IDS, compact_fields, expand_fields
+
+
+def test_round_trip_game_state():
+    message = {
+        'type': 'gameState',
+        'data': {
+            'players': [{'id': 'p1', 'name': 'Ann', 'walletAddress': '0x1', 'isAI': False}],
+            'messages': [{'id': 'm1', 'senderId': 'p1', 'senderName': 'Ann', 'text': 'hi', 'timestamp': 1}],
+            'gameInProgress': True,
+            'currentGameId': '7',
+        },
+    }
+    compacted = compact_fields(message)
+    assert compacted[WIRE_FIELD_IDS['type']] == WIRE_TYPE_IDS['gameState']
+    assert WIRE_FIELD_IDS['players'] in compacted[WIRE_FIELD_IDS['data']]
+    assert expand_fields(compacted) == message
+
+
+def test_batches_round_trip():
+    batch = [{'type': 'pong'}, {'type': 'newMessage', 'message': {'text': 'x'}}]
+    assert expand_fields(compact_fields(batch)) == batch
+
+
+def test_vote_counts_keys_are_left_alone():
+    # voteCounts is keyed by player id; a player called "name" must not become a field id
+    message = {'type': 'gameState', 'data': {'gameResults': {'voteCounts': {'name': 2, 'type': 1, 'p3': 0}}}}
+    compacted = compact_fields(message)
+    results = compacted[WIRE_FIELD_IDS['data']][WIRE_FIELD_IDS['gameResults']]
+    assert results[WIRE_FIELD_IDS['voteCounts']] == {'name': 2, 'type': 1, 'p3': 0}
+    assert expand_fields(compacted) == message
+
+
+def test_unknown_fields_and_types_pass_through():
+    message = {'type': 'somethingNew', 'extra': {'nested': [1, 2]}}
+    compacted = compact_fields(message)
+    assert compacted[WIRE_FIELD_IDS['type']] == 'somethingNew'
+    assert compacted['extra'] == {'nested': [1, 2]}
+    assert expand_fields(compacted) == message
+
+
+def test_out_of_range_ids_are_kept():
+    assert expand_fields({10_000: 'x', WIRE_FIELD_IDS['type']: 10_000}) == {10_000: 'x', 'type': 10_000}
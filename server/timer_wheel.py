@@ -0,0 +1,75 @@
+from typing import Dict, List, Set
+
+
+class TimerWheel:
+    """Hashed timer wheel for cheap scheduling of many per-key deadlines.
+
+    Every key remembers the absolute tick it was slotted into. Rescheduling a
+    key only records its new deadline and tick; entries left behind in older
+    slots are dropped lazily when their slot comes around, so touching a key on
+    every frame stays O(1).
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64, now: float = 0.0):
+        self.resolution = resolution
+        self.slots: List[Set[str]] = [set() for _ in range(slots)]
+        self.deadlines: Dict[str, float] = {}
+        self.ticks: Dict[str, int] = {}
+        self.within_tick: Set[str] = set()  # Reached their tick, but not their deadline yet
+        self.current_tick = int(now / resolution)
+
+    def _tick(self, deadline: float) -> int:
+        # Never schedule into a tick that has already been processed
+        return max(int(deadline / self.resolution), self.current_tick + 1)
+
+    def _slot(self, key: str, tick: int):
+        self.ticks[key] = tick
+        self.slots[tick % len(self.slots)].add(key)
+
+    def schedule(self, key: str, deadline: float):
+        """Set (or move) the deadline for a key"""
+        self.deadlines[key] = deadline
+        self._slot(key, self._tick(deadline))
+
+    def cancel(self, key: str):
+        """Forget a key; its slot entry is cleaned up lazily"""
+        self.deadlines.pop(key, None)
+        self.ticks.pop(key, None)
+
+    def advance(self, now: float) -> List[str]:
+        """Advance the wheel to `now` and return the keys whose deadline has passed"""
+        expired = []
+        target_tick = int(now / self.resolution)
+        for key in list(self.within_tick):
+            key_tick = self.ticks.get(key)
+            if key_tick is None or key_tick > self.current_tick:
+                # Cancelled or rescheduled, a slot entry owns it now
+                self.within_tick.discard(key)
+            elif self.deadlines[key] <= now:
+                self.within_tick.discard(key)
+                del self.deadlines[key]
+                del self.ticks[key]
+                expired.append(key)
+        # Don't spin through more than one full rotation after a long stall
+        start_tick = max(self.current_tick + 1, target_tick - len(self.slots) + 1)
+        for tick in range(start_tick, target_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in list(slot):
+                key_tick = self.ticks.get(key)
+                if key_tick is None or key_tick % len(self.slots) != tick % len(self.slots):
+                    # Cancelled, or rescheduled into another slot
+                    slot.discard(key)
+                    continue
+                if key_tick > tick:
+                    # Due on a later rotation of this slot
+                    continue
+                slot.discard(key)
+                if self.deadlines[key] <= now:
+                    del self.deadlines[key]
+                    del self.ticks[key]
+                    expired.append(key)
+                else:
+                    # Due later within the tick we're stopping in, keep checking it
+                    self.within_tick.add(key)
+        self.current_tick = max(self.current_tick, target_tick)
+        return expired
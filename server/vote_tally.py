@@ -0,0 +1,72 @@
+from typing import Dict, Set
+
+
+class VoteTally:
+    """Running tallies for one voting round.
+
+    Keeps per-candidate counts, candidates bucketed by count (so the leader is
+    known without a scan) and how many eligible voters are still missing, so
+    every vote and every departure is O(1).
+    """
+
+    def __init__(self, eligible_voters, player_names: Dict[str, str]):
+        self.eligible: Set[str] = set(eligible_voters)
+        self.names = dict(player_names)
+        self.ballots: Dict[str, str] = {}          # voter id -> candidate id
+        self.counts: Dict[str, int] = {}           # candidate id -> votes
+        self.by_count: Dict[int, Dict[str, None]] = {}  # votes -> candidates, in the order they got there
+        self.max_count = 0
+        self.remaining = len(self.eligible)
+
+    def _adjust(self, candidate_id: str, delta: int):
+        old_count = self.counts.get(candidate_id, 0)
+        new_count = old_count + delta
+        if old_count:
+            del self.by_count[old_count][candidate_id]
+        if new_count:
+            self.counts[candidate_id] = new_count
+            self.by_count.setdefault(new_count, {})[candidate_id] = None
+        else:
+            del self.counts[candidate_id]
+        
+        if new_count > self.max_count:
+            self.max_count = new_count
+        while self.max_count and not self.by_count.get(self.max_count):
+            self.max_count -= 1
+
+    def cast(self, voter_id: str, candidate_id: str):
+        """Record a vote, replacing the voter's previous one if any"""
+        previous = self.ballots.get(voter_id)
+        if previous == candidate_id:
+            return
+        if previous is None:
+            if voter_id in self.eligible:
+                self.remaining -= 1
+        else:
+            self._adjust(previous, -1)
+        self.ballots[voter_id] = candidate_id
+        self._adjust(candidate_id, 1)
+
+    def add_voter(self, voter_id: str, name: str):
+        """A player joined while voting is open"""
+        self.names[voter_id] = name
+        if voter_id not in self.eligible:
+            self.eligible.add(voter_id)
+            if voter_id not in self.ballots:
+                self.remaining += 1
+
+    def remove_voter(self, voter_id: str):
+        """A player left while voting is open. Their vote, if cast, still counts."""
+        if voter_id in self.eligible:
+            self.eligible.discard(voter_id)
+            if voter_id not in self.ballots:
+                self.remaining -= 1
+
+    def leader(self):
+        """Candidate with the most votes (first to reach that count wins ties), or None"""
+        if not self.max_count:
+            return None
+        return next(iter(self.by_count[self.max_count]))
+
+    def complete(self) -> bool:
+        return self.remaining <= 0
@@ -0,0 +1,53 @@
+# Short field ids used by the binary protocol. Append only, clients rely on the numbering.
+WIRE_FIELDS = [
+    'type', 'data', 'players', 'player', 'message', 'messages', 'id', 'name',
+    'senderId', 'senderName', 'text', 'timestamp', 'gameInProgress', 'nextGameTime',
+    'currentGameId', 'votingOpen', 'gameResults', 'isAI', 'walletAddress', 'playerId',
+    'prompt', 'voterId', 'votedForId', 'aiPlayerId', 'aiPlayerName', 'aiPlayerAddress',
+    'mostVotedPlayerId', 'mostVotedPlayerName', 'voteCounts', 'correctIdentification',
+    'throttled', 'roomId',
+]
+WIRE_TYPES = [
+    'gameState', 'playersUpdate', 'newMessage', 'joinConfirmed', 'voteConfirmed',
+    'promptConfirmed', 'errorMessage', 'pong', 'joinGame', 'playerLeft', 'chatMessage',
+    'submitPrompt', 'createGame', 'vote', 'ping', 'getState', 'reset', 'spectate',
+    'diagnostics', 'getStats', 'stats',
+]
+WIRE_FIELD_IDS = {name: i for i, name in enumerate(WIRE_FIELDS)}
+WIRE_TYPE_IDS = {name: i for i, name in enumerate(WIRE_TYPES)}
+# Fields whose value is a map keyed by data (player ids), not by field names
+WIRE_OPAQUE_FIELDS = {'voteCounts'}
+
+def compact_fields(value):
+    """Replace known field names (and message types) with their short wire ids"""
+    if isinstance(value, list):
+        return [compact_fields(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    
+    compacted = {}
+    for key, field_value in value.items():
+        if key == 'type':
+            field_value = WIRE_TYPE_IDS.get(field_value, field_value)
+        elif key not in WIRE_OPAQUE_FIELDS:
+            field_value = compact_fields(field_value)
+        compacted[WIRE_FIELD_IDS.get(key, key)] = field_value
+    return compacted
+
+def expand_fields(value):
+    """Inverse of compact_fields"""
+    if isinstance(value, list):
+        return [expand_fields(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    
+    expanded = {}
+    for key, field_value in value.items():
+        name = WIRE_FIELDS[key] if isinstance(key, int) and 0 <= key < len(WIRE_FIELDS) else key
+        if name == 'type':
+            if isinstance(field_value, int) and 0 <= field_value < len(WIRE_TYPES):
+                field_value = WIRE_TYPES[field_value]
+        elif name not in WIRE_OPAQUE_FIELDS:
+            field_value = expand_fields(field_value)
+        expanded[name] = field_value
+    return expanded